@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import discord
+from discord import app_commands
 from discord.ext import commands,tasks
 import asyncio
 import os
@@ -8,7 +9,6 @@ import re
 from functools import wraps,partial
 import sqlite3
 import time
-from collections import OrderedDict
 import requests
 import urllib.parse as urlparse
 from lxml import html as lxmlhtml
@@ -17,10 +17,15 @@ import json,hashlib # for daily deal
 from fractions import Fraction
 import math
 from urllib.parse import quote as urlquote
-from scrape_poe_wiki import get_lab_urls
+from scrape_poe_wiki import get_lab_urls, HTTPCache
 from enum import Enum
 from pathlib import Path
 import cloudscraper
+import ratelimit
+import sparkline
+import fanout
+import scheduler
+import glob
 WIKI_BASE = 'https://www.poewiki.net/wiki/'
 abspath = os.path.abspath(__file__)
 dname = os.path.dirname(abspath)
@@ -39,7 +44,6 @@ DIGIT_EMOJI = ['\U00000031\U000020E3',
                 '\U00000037\U000020E3',
                 '\U00000038\U000020E3',
                 '\U00000039\U000020E3']
-SEARCH_LIMIT = 999
 MAX_EMBED_VALUE_LEN = 1024
 
 SMALL_CURRENCY = 'chaosValue'
@@ -47,6 +51,10 @@ SMALL_CURRENCY_LABEL = 'c'
 LARGE_CURRENCY = 'divineValue'
 LARGE_CURRENCY_LABEL = 'div'
 LARGE_CURRENCY_NAME = 'Divine Orb'
+TREND_DAYS = 7
+TREND_CACHE_DIR = 'trend_cache'
+FORUM_POLL_SECONDS = 60*60 # www.pathofexile.com has banned the bot for polling too often before, only lower this once conditional GETs are known to get 304s there
+LAB_PREWARM_HOURS = 3 # keep retrying the lab prewarm this long after the daily rollover (utc)
 class restrictedView(discord.ui.View):
     ephemeral_msg = False
     message = None
@@ -116,16 +124,23 @@ class BotWithReactions(commands.Bot):
     REACTIONBUTTONS={}
     EMBEDPAGES = {}
     CLEANUP_TIMEOUT = 60 # seconds
-    AUTO_CLEANUP = OrderedDict()
     CLEANUP_KEY = 0
+    # deadlines of the auto deleted failure messages
+    EXPIRY = scheduler.Scheduler()
     DEFAULT_FAILURE_MSG = '```No Results.```'
     async def send_failure_message(self,destination,failure_message=DEFAULT_FAILURE_MSG,message=None,**kwargs):
         ''' message is the user message the bot is replying to. if provided we can autodelete failure messages if the original is edited. '''
         sent_msg = await destination.send(content=failure_message, **kwargs)
         if not destination.type == PRIVATE_CHANNEL:
-            self.AUTO_CLEANUP[message or self.CLEANUP_KEY] = (time.time(),sent_msg)
+            self.EXPIRY.schedule(('cleanup',message or self.CLEANUP_KEY),self.CLEANUP_TIMEOUT,partial(self.delete_expired,sent_msg))
             self.CLEANUP_KEY = (self.CLEANUP_KEY+1)%1000000
         return sent_msg
+    async def send_to_channel(self, channel_id, **kwargs):
+        ''' send_message by channel id, for the announcement queue '''
+        channel = self.get_channel(channel_id)
+        if channel is None:
+            raise LookupError('channel %s not found'%channel_id)
+        return await self.send_message(channel, **kwargs)
     async def send_file(self, destination, fp, failure_message=DEFAULT_FAILURE_MSG, filename='file.png', **kwargs):
         if fp:
             sent_msg = await destination.send(file=discord.File(fp, filename),**kwargs)
@@ -170,20 +185,16 @@ class BotWithReactions(commands.Bot):
             sent_msg = await self.send_message(*args, code_block=code_block, **kwargs)
         return sent_msg
 
-    async def auto_cleanup(self):
-        now = time.time()
-        while len(self.AUTO_CLEANUP):
-            key = next(iter(self.AUTO_CLEANUP))
-            if now - self.AUTO_CLEANUP[key][0] > self.CLEANUP_TIMEOUT:
-                _,(_,msg) = self.AUTO_CLEANUP.popitem()
-                await self.delete_message(msg)
-            else:
-                break
+    async def delete_expired(self,msg):
+        try:
+            await self.delete_message(msg)
+        except discord.NotFound:
+            pass # deleted by hand already
     async def edited_cleanup(self,msg):
-        if msg in self.AUTO_CLEANUP:
-            _,todel = self.AUTO_CLEANUP[msg]
-            del self.AUTO_CLEANUP[msg] # there is a race condition here as auto cleanup can occur in the same instant as this del
-            await self.delete_message(todel)
+        # the failure message is deleted right away instead of at its deadline
+        delete = self.EXPIRY.cancel(('cleanup',msg))
+        if delete:
+            await delete()
             
     async def process_reactions(self,message_id,emoji,new_author=None,remove=False):
         '''call this in on_reaction_add. For non-restricted buttons new_author must be passed (this will be the user allowed to delete the new message)
@@ -205,27 +216,6 @@ class BotWithReactions(commands.Bot):
             else:
                 await callback(msg,author,remove,*data,**kwargs)
                 
-    async def remove_stale_reactions(self):
-        '''Run this every ~1 second in a background loop. This simply removes reactions that have expired. (set REACTION_TIMEOUT)'''
-        now = time.time()
-        for key in list(self.REACTIONBUTTONS.keys()):
-            emoji = key[1]
-            msg_timestamp,_,msg,*_=self.REACTIONBUTTONS[key]
-            if now-msg_timestamp>self.REACTION_TIMEOUT:
-                self.REACTIONBUTTONS.pop(key,None)
-                try:
-                    await self.remove_all_reactions(msg,emoji)
-                except discord.NotFound:
-                    pass # this one means the message/reaction was deleted already so no big deal just ignore
-        for msg in list(self.EMBEDPAGES.keys()):
-            datediff = (datetime.datetime.now(datetime.timezone.utc) - msg.created_at)
-            if datediff.days*24*60*60 + datediff.seconds > self.REACTION_TIMEOUT:
-                pages = self.EMBEDPAGES.pop(msg,[])
-                for emoji in pages:
-                    try:
-                        await self.remove_all_reactions(msg,emoji)
-                    except discord.NotFound:
-                        pass # this one means the message/reaction was deleted already so no big deal just ignore
     async def obtain_user(self,uid):
         ret = self.get_user(uid)
         if ret:
@@ -246,30 +236,26 @@ class BotWithReactions(commands.Bot):
             except:
                 pass
             
+    async def setup_hook(self):
+        # registers the slash command versions of the lookups (see Info)
+        await self.tree.sync()
     async def on_ready(self):
         await self.change_presence(activity=discord.Game(name=self.command_prefix+'help'))
-        self.cleanup_reactions.start()
+        self.event_announcements.start()
     @tasks.loop(seconds=60.0)
-    async def cleanup_reactions(self):
+    async def event_announcements(self):
         try:
-            events = self.db.upcoming_event()
-            nextevent = self.db.event_ending()
+            events = await self.db.upcoming_event()
+            nextevent = await self.db.event_ending()
             if events or nextevent:
-                r=self.cursor.execute('SELECT channel FROM announce WHERE type="event"')
-                for channel in [i[0] for i in r.fetchall()]:
-                    try:
-                        if events:
-                            for event in events:
-                                await self.send_message(self.get_channel(channel), '%s'%str(event[0]))
-                        if nextevent:
-                            await self.send_message(self.get_channel(channel), 'diff\n%s'%nextevent)
-                    except:
-                        'channel missing or bot is blocked'
-            await self.remove_stale_reactions()
-            await self.auto_cleanup()
+                messages = [{'content':'%s'%str(event[0])} for event in events or ()]
+                if nextevent:
+                    messages.append({'content':'diff\n%s'%nextevent})
+                r = await self.sql.fetchall('SELECT channel FROM announce WHERE type="event"')
+                await self.announcements.announce('event',[(channel,messages) for channel, in r])
         except:
             'just for extra safety because an error here means the loop stops'
-    @cleanup_reactions.before_loop
+    @event_announcements.before_loop
     async def before_run(self):
         await self.wait_until_ready()
         
@@ -336,8 +322,7 @@ async def announce_internals(ctx,msg,announce_id,announce_name,commandname):
     if msg not in ('on','off',None):
         raise commands.BadArgument()
     if not msg:
-        r=bot.cursor.execute('SELECT 1 FROM announce WHERE channel=? AND type=?',(destination.id,announce_id))
-        enabled = r.fetchone()
+        enabled = await bot.sql.fetchone('SELECT 1 FROM announce WHERE channel=? AND type=?',(destination.id,announce_id))
         if destination.type == PRIVATE_CHANNEL:
             await bot.send_message(destination, '{} {}.'.format(announce_name,'enabled' if enabled else 'not enabled'))
         else:
@@ -345,15 +330,13 @@ async def announce_internals(ctx,msg,announce_id,announce_name,commandname):
         return
     else:
         if msg == 'on':
-            bot.cursor.execute('REPLACE INTO announce (channel,type) VALUES (?,?)',(destination.id,announce_id))
-            bot.conn.commit()
+            await bot.sql.execute('REPLACE INTO announce (channel,type) VALUES (?,?)',(destination.id,announce_id))
             if destination.type == PRIVATE_CHANNEL:
                 await bot.send_message(destination, '{} enabled.'.format(announce_name))
             else:
                 await bot.send_message(destination, '{} enabled for {}.'.format(announce_name,destination.mention), code_block=False)
         else:
-            bot.cursor.execute('DELETE FROM announce WHERE channel=? AND type=?',(destination.id,announce_id))
-            bot.conn.commit()
+            await bot.sql.execute('DELETE FROM announce WHERE channel=? AND type=?',(destination.id,announce_id))
             if destination.type == PRIVATE_CHANNEL:
                 await bot.send_message(destination, '{} disabled.'.format(announce_name))
             else:
@@ -367,8 +350,7 @@ class Misc(commands.Cog):
     Set league for pricing in this channel, options are: tmpStandard, tmpHardcore, eventStandard, eventHardcore, Standard, Hardcore.'''
         destination = ctx.message.channel
         if not league:
-            r=bot.cursor.execute('SELECT league FROM pricecheck WHERE channel=?',(destination.id,))
-            league = (r.fetchone() or ('tmpStandard',))[0]
+            league = bot.settings.league(destination.id)
             if destination.type == PRIVATE_CHANNEL:
                 await bot.send_message(destination, 'Currently checking prices in {}. -help pcleague to change.'.format(league,))
             else:
@@ -376,8 +358,7 @@ class Misc(commands.Cog):
             return
         try:
             i = [a.lower() for a in db.VALID_PC_LEAGUES].index(league.lower())
-            bot.cursor.execute('REPLACE INTO pricecheck (channel,league) VALUES (?,?)',(destination.id,db.VALID_PC_LEAGUES[i]))
-            bot.conn.commit()
+            await bot.settings.set_league(destination.id,db.VALID_PC_LEAGUES[i])
             await bot.send_message(destination, 'Now pricechecking in {}.'.format(db.VALID_PC_LEAGUES[i]))
         except ValueError:
             await bot.send_message(destination, 'Not a valid league, must be one of: tmpStandard, tmpHardcore, eventStandard, eventHardcore, Standard, Hardcore')
@@ -385,11 +366,17 @@ class Misc(commands.Cog):
     @commands.command(pass_context=True,aliases=['nextrace','nextevent'])
     async def next(self, ctx):
         '''Displays the upcoming race.'''
-        nextmsg = bot.db.next_event()
+        nextmsg = await bot.db.next_event()
         if nextmsg:
             await bot.send_message(ctx.message.channel, '%s'%nextmsg)
         else:
             await bot.send_message(ctx.message.channel, 'No upcoming events.')
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def dbstats(self, ctx):
+        '''Show lookup cache counters.'''
+        await bot.send_message(ctx.message.channel, '\n'.join('{}: {}'.format(k,v) for k,v in bot.db.cache.stats().items()))
             
 class Alerts(commands.Cog):
     '''Toggle on/off automatic annoucements of the following:'''
@@ -422,12 +409,14 @@ class Alerts(commands.Cog):
         <regexp>: python regular expression (see python re module), will only show deals which match
         default (show all) is: .*'''
         if not regexp:
-            r = bot.cursor.execute('SELECT regexp FROM regexp_filters WHERE channel=? AND type=?',(ctx.message.channel.id,'dailydeal'))
-            res = r.fetchone()
+            res = bot.settings.regexp_filter(ctx.message.channel.id,'dailydeal')
             await bot.send_message(ctx.message.channel, 'Current filter is: {}'.format(res[0] if res else '.*'))
         else:
-            r = bot.cursor.execute('REPLACE INTO regexp_filters (channel,type,regexp) VALUES (?,?,?)',(ctx.message.channel.id,'dailydeal',regexp))
-            bot.conn.commit()
+            try:
+                await bot.settings.set_regexp_filter(ctx.message.channel.id,'dailydeal',regexp)
+            except re.error as e:
+                await bot.send_message(ctx.message.channel, 'Invalid regexp: {}'.format(e))
+                return
             await bot.send_message(ctx.message.channel, 'Filter set to: {}'.format(regexp))
 
     @commands.command(pass_context=True, invoke_without_command=True)
@@ -436,79 +425,163 @@ class Alerts(commands.Cog):
         '''[on|off]
     Turn event announcements on/off.'''
         await announce_internals(ctx,toggle,'event','Event announcements','events')
-async def multiple_choice_view(ctx, data, func, edit_func=None):
+async def multiple_choice_view(ctx, page, func, edit_func=None, interaction=None, fetch=None):
     '''<ctx>
         pass context from original command
-        <data>
-        list of data items, data['name'] will be displayed on buttons
+        <page>
+        db.Page of results, row['name'] will be displayed on buttons
         <func>
         function to create the embed, will be passed data when button is clicked.
         <edit_func>
         if defined, will call this instead to edit the existing message entirely.
+        <interaction>
+        deferred slash command interaction, the choices are its response instead of a new message.
+        <fetch>
+        the search that returned page, called with cursor= to load the other pages for the Prev/Next buttons.
     '''
-    # this ensures that exact matches will appear in the 9 results
-    data.sort(
-        key=lambda item: item['name'].lower() != ' '.join(ctx.args[2:]).lower()
-    )
     view = restrictedView(ctx)
-    for i in range(min(SEARCH_REACTION_LIMIT,len(data))):
-        button = discord.ui.Button(label=data[i]['name'])
-        async def show_item(interaction,idx=i):
-            await interaction.response.defer()
-            view.clear_buttons()
-            view.ephemeral_msg = False
-            if edit_func:
-                await edit_func(data[idx],ctx,interaction)
-            else:
-                view.message = await interaction.edit_original_response(content = None, embed = func(data[idx]), view=view)
-        button.callback = show_item
-        view.add_item(button)
-    sent_msg = await bot.send_deletable_message(ctx,ctx.message.channel, f'Multiple results, showing {min(len(data),SEARCH_REACTION_LIMIT)}/{len(data)}.', view=view)
+    total = page.total
+    # cursor each visited page was fetched with, the last one is the page shown
+    cursors = [None]
+    def show_page(page):
+        view.clear_buttons()
+        for row in page.rows:
+            button = discord.ui.Button(label=row['name'])
+            async def show_item(interaction,row=row):
+                await interaction.response.defer()
+                view.clear_buttons()
+                view.ephemeral_msg = False
+                if edit_func:
+                    await edit_func(row,ctx,interaction)
+                else:
+                    view.message = await interaction.edit_original_response(content = None, embed = func(row), view=view)
+            button.callback = show_item
+            view.add_item(button)
+        if fetch and (page.cursor or len(cursors)>1):
+            for label,disabled,step in (('Prev',len(cursors)==1,-1),('Next',page.cursor is None,1)):
+                button = discord.ui.Button(style=discord.ButtonStyle.primary,label=label,disabled=disabled,row=2)
+                async def turn(interaction,step=step,next_cursor=page.cursor):
+                    await interaction.response.defer()
+                    if step>0:
+                        cursors.append(next_cursor)
+                    else:
+                        cursors.pop()
+                    content = show_page(await fetch(cursor=cursors[-1]))
+                    view.message = await interaction.edit_original_response(content=f'```{content}```', view=view)
+                button.callback = turn
+                view.add_item(button)
+        first = (len(cursors)-1)*SEARCH_REACTION_LIMIT
+        return f'Multiple results, showing {first+1}-{first+len(page.rows)}/{total}.'
+    content = show_page(page)
+    if interaction:
+        sent_msg = await interaction.edit_original_response(content=f'```{content}```', view=view)
+    else:
+        sent_msg = await bot.send_deletable_message(ctx,ctx.message.channel, content, view=view)
     view.message = sent_msg
     view.ephemeral_msg = True
     return sent_msg
 
+# name lookups shared by the prefix and slash commands, each retries with the closest name when nothing matches.
+# they return the first db.Page and the search (for multiple_choice_view to load more pages)
+async def _find_uniques(name, league):
+    fetch = partial(bot.db.get_data,'unique_items',name,league,limit=SEARCH_REACTION_LIMIT)
+    page = await fetch()
+    if not page.rows:
+        # typo or a base type, the fuzzy index tells which one instead of scanning again for both
+        for table,closest in await bot.db.suggest(name,('unique_items','baseitem'),limit=1):
+            fetch = partial(bot.db.get_data,'unique_items',closest,league,search_by_baseitem=table=='baseitem',limit=SEARCH_REACTION_LIMIT)
+            page = await fetch()
+    return page, fetch
+
+async def _find_skills(name, league):
+    fetch = partial(bot.db.get_skill_data,'skill_gems',name,league,limit=SEARCH_REACTION_LIMIT)
+    page = await fetch()
+    if not page.rows:
+        for table,closest in await bot.db.suggest(name,('skill_gems',),limit=1):
+            fetch = partial(bot.db.get_skill_data,'skill_gems',closest,league,limit=SEARCH_REACTION_LIMIT)
+            page = await fetch()
+    return page, fetch
+
+async def _find_currency(name, league):
+    fetch = partial(bot.db.get_currency,name,league,limit=SEARCH_REACTION_LIMIT)
+    page = await fetch()
+    if not page.rows:
+        for table,closest in await bot.db.suggest(name,('ninja_currency_data',),limit=1):
+            fetch = partial(bot.db.get_currency,closest,league,limit=SEARCH_REACTION_LIMIT,exact=True)
+            page = await fetch()
+    return page, fetch
+
+async def _find_nodes(name):
+    fetch = partial(bot.db.get_data,'passive_skills',name,limit=SEARCH_REACTION_LIMIT)
+    page = await fetch()
+    if not page.rows:
+        for table,closest in await bot.db.suggest(name,('passive_skills',),limit=1):
+            fetch = partial(bot.db.get_data,'passive_skills',closest,limit=SEARCH_REACTION_LIMIT)
+            page = await fetch()
+    return page, fetch
+
+def _choices(completions):
+    ''' autocomplete choices from AsyncPoeDB.complete, with the price next to the name when there is one '''
+    return [app_commands.Choice(name=(name if value is None else f'{name} ({round(value,1):g}{SMALL_CURRENCY_LABEL})')[:100], value=name[:100])
+            for name,value in completions]
+
 class Info(commands.Cog):
     'Show info on in-game items. These commands have short aliases for quicker use (ex: -u)'
-    @commands.command(pass_context=True, aliases=['u','pc','us'])
+    @commands.command(pass_context=True, aliases=['u','pc','us','um'])
     async def unique(self, ctx, *itemname: str):
         '''<itemname>
     Shows stats for an item. Partial names acceptable.
     search <key words> (alias: -us)
-    Search for items whose explicit mods contain ALL keywords.'''
+    Search for items whose explicit mods contain ALL keywords.
+    mods [<value>|<min>-<max>] <mod words> (alias: -um)
+    Search for items with a mod that can roll the value, best roll first. ex: -um 80 maximum life'''
         if not len(itemname):
             raise commands.BadArgument
         # consider showing flavor text in the embed footer
         item = ' '.join(itemname)
-        r=bot.cursor.execute('SELECT league FROM pricecheck WHERE channel=?',(ctx.message.channel.id,))
-        league = (r.fetchone() or ('tmpStandard',))[0]
+        league = bot.settings.league(ctx.message.channel.id)
+        create_embed = partial(_create_unique_embed, rates=await bot.db.league_rates(league))
         
         if itemname[0].lower() == 'search' or ctx.invoked_with == 'us':
             if (len(itemname) + (ctx.invoked_with == 'us'))<2:
                 await bot.send_message(ctx.message.channel, 'usage: -us <key words>')
                 return
-            data = bot.db.unique_search_explicit(itemname[(ctx.invoked_with != 'us'):],league,limit=SEARCH_LIMIT)
-            if not data:
+            fetch = partial(bot.db.unique_search_explicit,itemname[(ctx.invoked_with != 'us'):],league,limit=SEARCH_REACTION_LIMIT)
+            page = await fetch()
+            if not page.rows:
                 await bot.send_failure_message(ctx.message.channel)
                 return
-            if len(data)>1:
+            if page.total>1:
                 #send choices
-                await multiple_choice_view(ctx,data,_create_unique_embed)
+                await multiple_choice_view(ctx,page,create_embed,fetch=fetch)
                 return
-            e = _create_unique_embed(data[0])
+            e = create_embed(page.rows[0])
             await bot.send_deletable_message(ctx, ctx.message.channel, embed=e)
             return
-        data = bot.db.get_data('unique_items',item,league,limit=SEARCH_LIMIT)
-        if not data:
-            data = bot.db.get_data('unique_items',item,league,search_by_baseitem=True,limit=SEARCH_LIMIT)
-            if not data:
+        if itemname[0].lower() == 'mods' or ctx.invoked_with == 'um':
+            if (len(itemname) + (ctx.invoked_with == 'um'))<2:
+                await bot.send_message(ctx.message.channel, 'usage: -um [<value>|<min>-<max>] <mod words>')
+                return
+            fetch = partial(bot.db.unique_search_mods,itemname[(ctx.invoked_with != 'um'):],league,limit=SEARCH_REACTION_LIMIT)
+            page = await fetch()
+            if not page.rows:
                 await bot.send_failure_message(ctx.message.channel)
                 return
-        if len(data)>1:
+            if page.total>1:
+                await multiple_choice_view(ctx,page,create_embed,fetch=fetch)
+                return
+            e = create_embed(page.rows[0])
+            await bot.send_deletable_message(ctx, ctx.message.channel, embed=e)
+            return
+        page, fetch = await _find_uniques(item,league)
+        if not page.rows:
+            await bot.send_failure_message(ctx.message.channel)
+            return
+        if page.total>1:
             #send choices
-            await multiple_choice_view(ctx,data,_create_unique_embed)
+            await multiple_choice_view(ctx,page,create_embed,fetch=fetch)
             return
-        e = _create_unique_embed(data[0])
+        e = create_embed(page.rows[0])
         await bot.send_deletable_message(ctx, ctx.message.channel, embed=e)
         
     @commands.command(pass_context=True)
@@ -520,12 +593,11 @@ class Info(commands.Cog):
         if difficulty == 'merc':
             difficulty = 'merciless'
         today = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
-        r=bot.cursor.execute('select diff,img_url from daily_labs where date=?',(today,))
-        data = r.fetchall()
+        data = await bot.sql.fetchall('select diff,img_url from daily_labs where date=?',(today,))
         if not data:
-            _cache_labs()
-            r=bot.cursor.execute('select diff,img_url from daily_labs where date=?',(today,))
-            data = r.fetchall()
+            # prewarm hasn't got today's labs yet, wait for it (or the fetch another -lab already started)
+            await _cache_labs()
+            data = await bot.sql.fetchall('select diff,img_url from daily_labs where date=?',(today,))
         if not data:
             return await bot.send_failure_message(ctx.message.channel)
         LABS = dict(data)#'https://www.poelab.com/wp-content/labfiles/{}_{}.jpg'.format(datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d'), diff)
@@ -566,16 +638,15 @@ class Info(commands.Cog):
             raise commands.BadArgument
         # consider showing flavor text in the embed footer
         item = ' '.join(skill_name)
-        r=bot.cursor.execute('SELECT league FROM pricecheck WHERE channel=?',(ctx.message.channel.id,))
-        league = (r.fetchone() or ('tmpStandard',))[0]
-        data = bot.db.get_skill_data('skill_gems',item,league,limit=SEARCH_LIMIT)
-        if not data:
+        league = bot.settings.league(ctx.message.channel.id)
+        page, fetch = await _find_skills(item,league)
+        if not page.rows:
             await bot.send_failure_message(ctx.message.channel)
             return
-        if len(data)>1:
+        if page.total>1:
             #send choices
-            return await multiple_choice_view(ctx,data,None,edit_func=self._skill_internals)
-        await self._skill_internals(data[0],ctx)
+            return await multiple_choice_view(ctx,page,None,edit_func=self._skill_internals,fetch=fetch)
+        await self._skill_internals(page.rows[0],ctx)
         
     async def _skill_internals(self, data, ctx, interaction=None):
         # this is for the new format of vaal/trans gems being grouped together.
@@ -612,18 +683,49 @@ class Info(commands.Cog):
             raise commands.BadArgument
         # consider showing flavor text in the embed footer
         item = ' '.join(currency_name)
-        r=bot.cursor.execute('SELECT league FROM pricecheck WHERE channel=?',(ctx.message.channel.id,))
-        league = (r.fetchone() or ('tmpStandard',))[0]
-        data = bot.db.get_currency(item,league,limit=SEARCH_LIMIT)
-        if not data:
+        league = bot.settings.league(ctx.message.channel.id)
+        page, fetch = await _find_currency(item,league)
+        if not page.rows:
             await bot.send_failure_message(ctx.message.channel)
             return
-        if len(data)>1:
+        create_embed = partial(_create_currency_embed, rates=await bot.db.league_rates(league))
+        if page.total>1:
             #send choices
-            return await multiple_choice_view(ctx,data,_create_currency_embed)
-        e = _create_currency_embed(data[0])
+            return await multiple_choice_view(ctx,page,create_embed,fetch=fetch)
+        e = create_embed(page.rows[0])
         await bot.send_deletable_message(ctx, ctx.message.channel, embed=e)
         
+    @commands.command(pass_context=True)
+    async def trend(self, ctx, *item_name: str):
+        '''<name>
+    Shows a price chart of the last week for an item or currency. Partial names acceptable.'''
+        if not len(item_name):
+            raise commands.BadArgument
+        item = ' '.join(item_name)
+        league = bot.settings.league(ctx.message.channel.id)
+        fetch = partial(bot.db.get_priced,item,league,limit=SEARCH_REACTION_LIMIT)
+        page = await fetch()
+        if not page.rows:
+            await bot.send_failure_message(ctx.message.channel)
+            return
+        if page.total>1:
+            #send choices
+            return await multiple_choice_view(ctx,page,None,edit_func=partial(self._trend_internals,league=league),fetch=fetch)
+        await self._trend_internals(page.rows[0],ctx,league=league)
+
+    async def _trend_internals(self, data, ctx, interaction=None, league=None):
+        path, history = await _trend_chart(data['tablename'],data['id'],league)
+        e = _create_trend_embed(data, history)
+        view = restrictedView(ctx)
+        files = []
+        if path:
+            files = [discord.File(path, filename='trend.png')]
+            e.set_image(url='attachment://trend.png')
+        if interaction:
+            view.message = await interaction.edit_original_response(content=None, embed=e, attachments=files, view=view)
+        else:
+            await bot.send_deletable_message(ctx, ctx.message.channel, embed=e, files=files, view=view)
+
     @commands.command(pass_context=True, aliases=['p','n','ns','ps'])
     async def node(self, ctx, *skillname: str):
         '''<name>
@@ -637,44 +739,167 @@ class Info(commands.Cog):
             if (len(skillname) + (ctx.invoked_with.endswith('s')))<2:
                 await bot.send_message(ctx.message.channel, 'usage: -ns <key words>')
                 return
-            data = bot.db.passive_search_description(skillname[(not ctx.invoked_with.endswith('s')):],limit=SEARCH_LIMIT)
-            if not data:
+            fetch = partial(bot.db.passive_search_description,skillname[(not ctx.invoked_with.endswith('s')):],limit=SEARCH_REACTION_LIMIT)
+            page = await fetch()
+            if not page.rows:
                 await bot.send_failure_message(ctx.message.channel)
                 return
-            if len(data)>1:
+            if page.total>1:
                 # send choices
-                return await multiple_choice_view(ctx,data,_create_node_embed)
-            e = _create_node_embed(data[0])
+                return await multiple_choice_view(ctx,page,_create_node_embed,fetch=fetch)
+            e = _create_node_embed(page.rows[0])
             await bot.send_deletable_message(ctx, ctx.message.channel, embed=e)
             return
         
-        data = bot.db.get_data('passive_skills',name,limit=SEARCH_LIMIT)
-        if not data:
+        page, fetch = await _find_nodes(name)
+        if not page.rows:
             await bot.send_failure_message(ctx.message.channel)
             return
-        if len(data)>1:
+        if page.total>1:
             #send choices
-            return await multiple_choice_view(ctx,data,_create_node_embed)
-        e = _create_node_embed(data[0])
+            return await multiple_choice_view(ctx,page,_create_node_embed,fetch=fetch)
+        e = _create_node_embed(page.rows[0])
         await bot.send_deletable_message(ctx, ctx.message.channel, embed=e)
-        
-def _cache_labs():
+
+    # slash command versions of the lookups above. names are autocompleted from the in-memory prefix index
+    # (AsyncPoeDB.complete), so a picked name is one exact lookup instead of a list of choices.
+    async def _slash_results(self, interaction, found, func=None, edit_func=None):
+        ''' shows the (page, fetch) of a _find_* lookup as the response to a deferred slash command, like the prefix commands do '''
+        page, fetch = found
+        ctx = await commands.Context.from_interaction(interaction)
+        if not page.rows:
+            await interaction.edit_original_response(content=bot.DEFAULT_FAILURE_MSG)
+            return
+        if page.total>1:
+            await multiple_choice_view(ctx,page,func,edit_func=edit_func,interaction=interaction,fetch=fetch)
+            return
+        if edit_func:
+            await edit_func(page.rows[0],ctx,interaction)
+            return
+        view = restrictedView(ctx)
+        view.message = await interaction.edit_original_response(embed=func(page.rows[0]), view=view)
+
+    async def _complete(self, interaction, current, table):
+        league = bot.settings.league(interaction.channel_id)
+        return _choices(await bot.db.complete(current,table,league))
+
+    @app_commands.command(name='unique')
+    async def unique_slash(self, interaction: discord.Interaction, name: str):
+        '''Shows stats for a unique item.'''
+        await interaction.response.defer()
+        league = bot.settings.league(interaction.channel_id)
+        create_embed = partial(_create_unique_embed, rates=await bot.db.league_rates(league))
+        await self._slash_results(interaction, await _find_uniques(name,league), create_embed)
+
+    @unique_slash.autocomplete('name')
+    async def unique_autocomplete(self, interaction: discord.Interaction, current: str):
+        return await self._complete(interaction, current, 'unique_items')
+
+    @app_commands.command(name='skill')
+    async def skill_slash(self, interaction: discord.Interaction, name: str):
+        '''Shows stats for a skill gem.'''
+        await interaction.response.defer()
+        league = bot.settings.league(interaction.channel_id)
+        await self._slash_results(interaction, await _find_skills(name,league), edit_func=self._skill_internals)
+
+    @skill_slash.autocomplete('name')
+    async def skill_autocomplete(self, interaction: discord.Interaction, current: str):
+        return await self._complete(interaction, current, 'skill_gems')
+
+    @app_commands.command(name='currency')
+    async def currency_slash(self, interaction: discord.Interaction, name: str):
+        '''Shows exchange rate for a currency item.'''
+        await interaction.response.defer()
+        league = bot.settings.league(interaction.channel_id)
+        create_embed = partial(_create_currency_embed, rates=await bot.db.league_rates(league))
+        await self._slash_results(interaction, await _find_currency(name,league), create_embed)
+
+    @currency_slash.autocomplete('name')
+    async def currency_autocomplete(self, interaction: discord.Interaction, current: str):
+        return await self._complete(interaction, current, 'ninja_currency_data')
+
+    @app_commands.command(name='node')
+    async def node_slash(self, interaction: discord.Interaction, name: str):
+        '''Shows information about a passive skill notable or keystone.'''
+        await interaction.response.defer()
+        await self._slash_results(interaction, await _find_nodes(name), _create_node_embed)
+
+    @node_slash.autocomplete('name')
+    async def node_autocomplete(self, interaction: discord.Interaction, current: str):
+        return await self._complete(interaction, current, 'passive_skills')
+
+_lab_fetch = None
+async def _cache_labs():
+    ''' fetches today's labs into daily_labs, callers arriving while a fetch is running wait for that one instead of starting another '''
+    global _lab_fetch
+    if _lab_fetch is None or _lab_fetch.done():
+        _lab_fetch = asyncio.create_task(_fetch_labs())
+    # shielded so a cancelled command doesn't cancel the fetch for everyone else waiting on it
+    await asyncio.shield(_lab_fetch)
+
+async def _fetch_labs():
     today = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
-    for lab,url in zip(('normal','cruel','merciless','uber'),get_lab_urls(today)):
-        if url:
-            bot.cursor.execute('REPLACE INTO daily_labs (date,diff,img_url) VALUES (?,?,?)',(today,lab,url))
-    bot.cursor.execute('DELETE FROM daily_labs WHERE date <> ?',(today,))
-    bot.conn.commit()
+    urls = await asyncio.get_running_loop().run_in_executor(None, get_lab_urls, today)
+    await bot.sql.executemany('REPLACE INTO daily_labs (date,diff,img_url) VALUES (?,?,?)',[(today,lab,url) for lab,url in zip(('normal','cruel','merciless','uber'),urls) if url])
+    await bot.sql.execute('DELETE FROM daily_labs WHERE date <> ?',(today,))
+
+async def _trend_chart(table, id, league):
+    '''
+    returns (path of the rendered chart or None, history) for the last TREND_DAYS of an item's price_history.
+
+    charts are cached on disk per snapshot, so until the next ingest a popular item costs one file read.
+    '''
+    now = time.time()
+    since = int(now - TREND_DAYS*24*60*60)
+    history = await bot.db.price_history(table, id, league, since=since)
+    # snapshots where poe.ninja had no price for the item
+    history = [h for h in history if h['chaosValue'] is not None]
+    if not history:
+        return None, history
+    prefix = os.path.join(TREND_CACHE_DIR, re.sub(r'[^\w.-]', '_', '{}-{}-{}'.format(db.HISTORY_KINDS[table], id, league)))
+    path = '{}-{}.png'.format(prefix, bot.db.snapshot_id())
+    if os.path.exists(path):
+        return path, history
+    points = [(h['bucket'], h['chaosValue']) for h in history]
+    png = await asyncio.get_running_loop().run_in_executor(None, partial(sparkline.render, points, start=since, end=now))
+    os.makedirs(TREND_CACHE_DIR, exist_ok=True)
+    for old in glob.glob(glob.escape(prefix) + '-*.png'):
+        # another render of this snapshot may have just written path
+        if old != path:
+            os.remove(old)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(png)
+    os.replace(path + '.tmp', path)
+    return path, history
+
+def _create_trend_embed(data, history):
+    price = data[SMALL_CURRENCY]
+    if history:
+        first = history[0]['chaosValue']
+        values = [h['chaosValue'] for h in history]
+        change = f' ({(price-first)/first:+.0%})' if first else ''
+        stats_string = f'Now: **{price:g}**{SMALL_CURRENCY_LABEL}{change}\nLow: {min(values):g}{SMALL_CURRENCY_LABEL} High: {max(values):g}{SMALL_CURRENCY_LABEL}'
+    else:
+        stats_string = f'Now: **{price:g}**{SMALL_CURRENCY_LABEL}\nNot enough price history yet.'
+    e = discord.Embed(url=f'{WIKI_BASE}{urlquote(data["name"].replace(" ","_"))}',
+        description=stats_string,
+        title=f'{data["name"]}: last {TREND_DAYS} days',
+        type='rich',
+        color=0xaf601a)
+    if data['icon']:
+        e.set_thumbnail(url=data['icon'].replace(' ','%20'))
+    return e
 
 def _strip_html_tags(text):
     return re.sub(r'<(br|tr|hr)[^>]+>','\n',re.sub(r' \| ','\n',text)).replace('&lt;','<').replace('&gt;','>')
 
-def _create_currency_embed(data):
+def _create_currency_embed(data, rates):
+    ''' rates is the exchange rate table for this league, see db.AsyncPoeDB.league_rates '''
     price = data[SMALL_CURRENCY]
-    exaltValue = bot.db.get_currency(LARGE_CURRENCY_NAME,data['league'], exact=True,limit=SEARCH_LIMIT)[0][SMALL_CURRENCY]
+    exaltValue = rates.get(LARGE_CURRENCY_NAME)
     chaos_to_spend = 20
     limit = math.ceil(chaos_to_spend/price)
-    if data[SMALL_CURRENCY] > exaltValue * 2:
+    if exaltValue and data[SMALL_CURRENCY] > exaltValue * 2:
         stats_string = f'Est. Price: **{price}**{SMALL_CURRENCY_LABEL}\napprox. **{price/exaltValue:.1f}**{LARGE_CURRENCY_LABEL}'
     else:
         frac = Fraction(data[SMALL_CURRENCY]).limit_denominator(int(limit))
@@ -688,7 +913,8 @@ def _create_currency_embed(data):
         e.set_thumbnail(url=data['icon'].replace(' ','%20'))
     return e
 
-def _create_unique_embed(data):
+def _create_unique_embed(data, rates=None):
+    rates = rates or {}
     def if_not_zero(val,label):
         if val and val!='0':
             return label+' '+val+'\n'
@@ -703,9 +929,12 @@ def _create_unique_embed(data):
         return ''
     bold_nums = re.compile(r'(\(?-?(?:\d+(?:-|(?: to )))?\d*\.?\d+\)?%?)')
     bold_nums = re.compile(r'(\(?-?(?:\d*\.?\d+(?:-|(?: to )))?\d*\.?\d+\)?%?)')
-    if SMALL_CURRENCY in data.keys() and LARGE_CURRENCY in data.keys() and data[SMALL_CURRENCY] is not None and data[LARGE_CURRENCY] is not None:
-        if data[LARGE_CURRENCY] > 1:
-            stats_string = f'Est. Price: {data[LARGE_CURRENCY]:.1f}{LARGE_CURRENCY_LABEL}\n'
+    large_value = data[LARGE_CURRENCY] if LARGE_CURRENCY in data.keys() else None
+    if SMALL_CURRENCY in data.keys() and data[SMALL_CURRENCY] is not None and large_value is None and rates.get(LARGE_CURRENCY_NAME):
+        large_value = data[SMALL_CURRENCY] / rates[LARGE_CURRENCY_NAME]
+    if SMALL_CURRENCY in data.keys() and data[SMALL_CURRENCY] is not None and large_value is not None:
+        if large_value > 1:
+            stats_string = f'Est. Price: {large_value:.1f}{LARGE_CURRENCY_LABEL}\n'
         else:
             stats_string = f'Est. Price: {data[SMALL_CURRENCY]:.0f}{SMALL_CURRENCY_LABEL}\n'
     else:
@@ -891,51 +1120,73 @@ def _create_node_embed(data):
 
     return e
 
-def cloudscraper_get(url):
-    with cloudscraper.create_scraper() as s:
-        return s.get(url)
+# one long lived scraper per host, keeps its connections and cloudflare cookies between polls
+_sessions = {}
+def _session(url):
+    host = urlparse.urlsplit(url).hostname
+    if host not in _sessions:
+        _sessions[host] = cloudscraper.create_scraper()
+    return _sessions[host]
+
+_http_caches = {}
+def _http_cache(url):
+    ''' response cache of one polled source, revalidated with ETag/Last-Modified. a new response stays pending until commit() so a failed scrape is retried next poll '''
+    if url not in _http_caches:
+        _http_caches[url] = HTTPCache(session=_session(url), autocommit=False)
+    return _http_caches[url]
+
+async def scraper_get(url):
+    return await asyncio.get_running_loop().run_in_executor(None, partial(ratelimit.get, url, session=_session(url)))
+
+async def _thread_image(url):
+    ''' header image of a forum announcement (these only appear in forum announcements), None if there is none '''
+    try:
+        data = await scraper_get(url)
+        if data.status_code == 200:
+            etree = lxmlhtml.fromstring(data.text)
+            return etree.xpath('//tr[contains(@class,"newsPost")]//img/@src')[0]
+    except:
+        pass
+    return None
 
 # will return a list of embeds for all "unread" announcements
 # returns tuples of (embed, filterable text or None)
 async def scrape_forum(section = 'https://www.pathofexile.com/forum/view-forum/news', table = 'forum_announcements', header = 'Forum - Announcements'):
     MAX_SIMUL_ANNOUNCEMENTS = 3 # to prevent spamming if the bot/forums are down.
-    loop = asyncio.get_event_loop() # could also use bot.loop or whatever it is
-    future = loop.run_in_executor(None, cloudscraper_get, section)
-    data = await future
-    etree = lxmlhtml.fromstring(data.text)
-    titles = [a.strip() for a in etree.xpath('//div[@class="title"]/a/text()')]
-    urls = [urlparse.urljoin('https://www.pathofexile.com/',a) for a in etree.xpath('//div[@class="title"]/a/@href')]
-    threadnums = [a.split('/')[-1] for a in urls]
-    threads = list(zip(titles,urls,threadnums))
-    announces = []
-    r=bot.cursor.execute('SELECT threadnum FROM `{}` WHERE threadnum IN ({})'.format(table, ','.join([x[2] for x in threads])))
-    already_parsed = [x[0] for x in r.fetchall()]
-
-    new_threads = filter(lambda x: x[2] not in already_parsed,threads)
-    for thread in new_threads:
-        embed_img = None
-        # try to get a header image, literally (these only appear in forum announcements)
-        try:
-            if table == 'forum_announcements':
-                loop = asyncio.get_event_loop()
-                future = loop.run_in_executor(None, cloudscraper_get, thread[1])
-                data = await future
-
-                if data.status_code == 200:
-                    etree = lxmlhtml.fromstring(data.text)
-                    embed_img = etree.xpath('//tr[contains(@class,"newsPost")]//img/@src')[0]
-        except:
-            pass
-        r=bot.cursor.execute('SELECT 1 FROM %s WHERE threadnum=?'%table,(thread[2],))
-        if r.fetchone():
-            break
-        else:
-            #announce.
-            bot.cursor.execute('INSERT INTO %s (title,url,threadnum) VALUES (?,?,?)'%table,thread)
-            bot.conn.commit()
-            if MAX_SIMUL_ANNOUNCEMENTS > 0:
-                announces.append((_create_forum_embed(thread[1],thread[0],header,img=embed_img),None))
-                MAX_SIMUL_ANNOUNCEMENTS -= 1
+    cache = _http_cache(section)
+    text, changed = await asyncio.get_running_loop().run_in_executor(None, cache.get, section)
+    if not changed:
+        # the same body again, keep its new ETag/Last-Modified so it isn't left pending
+        cache.commit()
+        return []
+    try:
+        etree = lxmlhtml.fromstring(text)
+        titles = [a.strip() for a in etree.xpath('//div[@class="title"]/a/text()')]
+        urls = [urlparse.urljoin('https://www.pathofexile.com/',a) for a in etree.xpath('//div[@class="title"]/a/@href')]
+        threadnums = [a.split('/')[-1] for a in urls]
+        threads = list(zip(titles,urls,threadnums))
+        announces = []
+        r = await bot.sql.fetchall('SELECT threadnum FROM `{}` WHERE threadnum IN ({})'.format(table, ','.join('?'*len(threads))),threadnums)
+        already_parsed = [x[0] for x in r]
+
+        new_threads = [x for x in threads if x[2] not in already_parsed]
+        # only the announced threads get an image, all fetched at once
+        images = [None]*len(new_threads)
+        if table == 'forum_announcements':
+            images[:MAX_SIMUL_ANNOUNCEMENTS] = await asyncio.gather(*[_thread_image(thread[1]) for thread in new_threads[:MAX_SIMUL_ANNOUNCEMENTS]])
+        for thread,embed_img in zip(new_threads,images):
+            if await bot.sql.fetchone('SELECT 1 FROM %s WHERE threadnum=?'%table,(thread[2],)):
+                break
+            else:
+                #announce.
+                await bot.sql.execute('INSERT INTO %s (title,url,threadnum) VALUES (?,?,?)'%table,thread)
+                if MAX_SIMUL_ANNOUNCEMENTS > 0:
+                    announces.append((_create_forum_embed(thread[1],thread[0],header,img=embed_img),None))
+                    MAX_SIMUL_ANNOUNCEMENTS -= 1
+    except:
+        cache.discard()
+        raise
+    cache.commit()
     return announces
 
 # returns tuples of (embed, filterable text or None)
@@ -943,16 +1194,25 @@ async def scrape_deals(deal_api = 'https://www.pathofexile.com/api/shop/microtra
 ##    r=bot.cursor.execute('''select 1 from daily_deals where datetime(end_date)>datetime('now')''')
 ##    if r.fetchone(): #ongoing deal, no need to check for new ones.
 ##        return None
-    loop = asyncio.get_event_loop() # could also use bot.loop or whatever it is
-    future = loop.run_in_executor(None, cloudscraper_get, deal_api)
-    data = await future
-    data.raise_for_status()
-    js = data.json()
+    cache = _http_cache(deal_api)
+    text, changed = await asyncio.get_running_loop().run_in_executor(None, cache.get, deal_api)
+    if not changed:
+        # the same body again, keep its new ETag/Last-Modified so it isn't left pending
+        cache.commit()
+        return []
+    try:
+        deals = await _new_deals(json.loads(text))
+    except:
+        cache.discard()
+        raise
+    cache.commit()
+    return deals
+
+async def _new_deals(js):
     if js['total'] == 0:
         return []
     itemhash = hashlib.md5(json.dumps(js, sort_keys=True).encode('utf8')).hexdigest()
-    r=bot.cursor.execute('SELECT 1 FROM daily_deals WHERE hash=?',(itemhash,))
-    if r.fetchone():
+    if await bot.sql.fetchone('SELECT 1 FROM daily_deals WHERE hash=?',(itemhash,)):
         return []
     start_dates = set([i['startAt'] for i in js['entries']])
     latest_deal = sorted(start_dates)[-1]
@@ -965,9 +1225,8 @@ async def scrape_deals(deal_api = 'https://www.pathofexile.com/api/shop/microtra
     if int(js['total']) >2:
         title += ' | + %i more'%(int(js['total'])-2)
     #announce.
-    bot.cursor.execute('REPLACE INTO daily_deals (title,img_url,hash,end_date) VALUES (?,?,?,?)',(title,img_url,itemhash,end_date))
-    bot.cursor.execute('''DELETE FROM daily_deals WHERE ROWID IN (SELECT ROWID FROM daily_deals ORDER BY ROWID DESC LIMIT -1 OFFSET 7)''')
-    bot.conn.commit()
+    await bot.sql.execute('REPLACE INTO daily_deals (title,img_url,hash,end_date) VALUES (?,?,?,?)',(title,img_url,itemhash,end_date))
+    await bot.sql.execute('''DELETE FROM daily_deals WHERE ROWID IN (SELECT ROWID FROM daily_deals ORDER BY ROWID DESC LIMIT -1 OFFSET 7)''')
     return ((_create_deal_embed(title,img_url),'\n'.join(latest_names)),)
 
 def _create_forum_embed(url,title,name='Forum Announcement',thumb_url='https://web.poecdn.com/image/favicon/ogimage.png?v=1',img=None):
@@ -993,43 +1252,63 @@ class backgroundTasks(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.forum_announcements.start()
+        self.prewarm_labs.start()
 
     def cog_unload(self):
         self.forum_announcements.cancel()
+        self.prewarm_labs.cancel()
 
-    @tasks.loop(seconds=3600.0)
+    # labs roll over at midnight UTC and poelab posts the new layouts some minutes later
+    @tasks.loop(time=[datetime.time(hour, minute, tzinfo=datetime.timezone.utc) for hour in range(LAB_PREWARM_HOURS) for minute in range(5,60,10)])
+    async def prewarm_labs(self):
+        try:
+            await self.cache_labs()
+        except Exception as e:
+            print('error prewarming labs: %r'%e)
+
+    async def cache_labs(self):
+        ''' fetches today's labs unless all 4 are cached already '''
+        today = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
+        r = await bot.sql.fetchone('SELECT COUNT(*) FROM daily_labs WHERE date=?',(today,))
+        if r[0] < 4:
+            await _cache_labs()
+
+    @prewarm_labs.before_loop
+    async def before_prewarm(self):
+        await self.bot.wait_until_ready()
+        # the scheduled times may be hours away, so fill the cache on startup too
+        try:
+            await self.cache_labs()
+        except Exception as e:
+            print('error prewarming labs: %r'%e)
+
+    @tasks.loop(seconds=FORUM_POLL_SECONDS)
     async def forum_announcements(self):
         # return # rate limit changed so this results in ban
         announce_types = [('forumannounce',partial(scrape_forum)),
                           ('patchnotes',partial(scrape_forum,'https://www.pathofexile.com/forum/view-forum/patch-notes','patch_notes','Forum - Patch Notes')),
                            ('dailydeal',partial(scrape_deals))]
-        for name,func in announce_types:
-            try:
-                data = await func()
-                if data:
-                    # get filters from this channel if found.
-                    # compare to filterable string which func() should return. meaning we need to modify func.
-                    # only send embed if filter matches.
-                    r=bot.cursor.execute('SELECT channel FROM announce WHERE type=?',(name,))
-                    for channel in [i[0] for i in r.fetchall()]:
-                        try:
-                            for e,filterstr in data:
-                                r2=bot.cursor.execute('SELECT regexp FROM regexp_filters WHERE type=? AND channel=?',(name,channel))
-                                regex = r2.fetchone()
-                                if regex and filterstr:
-                                    if not re.search(regex[0],filterstr,flags=re.I|re.M):
-                                        continue
-                                await bot.send_message(bot.get_channel(channel), embed=e)
-                        except:
-                            'channel missing or bot is blocked'
-                            # raise
-            except Exception as e:
-                print('error scraping forums (%s): %r'%(name,e))
-                # raise
-                'just for extra safety because an error here means the loop stops'
-                'this can be caused by things like maintenance'
-            finally:
-                await asyncio.sleep(120)
+        # sources are polled at the same time, the host's ratelimit bucket still spaces out the requests
+        await asyncio.gather(*[self.announce(name,func) for name,func in announce_types])
+
+    async def announce(self, name, func):
+        try:
+            data = await func()
+            if data:
+                # only send embeds whose filterable string (which func() returns) matches the channel's filter, if it has one.
+                # filters are compiled once in bot.settings, so this is a dict lookup per channel.
+                r = await bot.sql.fetchall('SELECT channel FROM announce WHERE type=?',(name,))
+                deliveries = []
+                for channel, in r:
+                    regex = bot.settings.regexp_filter(channel,name)
+                    deliveries.append((channel,[{'embed':e} for e,filterstr in data
+                                                if not (regex and filterstr) or regex[1].search(filterstr)]))
+                await bot.announcements.announce(name,deliveries)
+        except Exception as e:
+            print('error scraping forums (%s): %r'%(name,e))
+            # raise
+            'just for extra safety because an error here means the loop stops'
+            'this can be caused by things like maintenance'
 
     @forum_announcements.before_loop
     async def before_run(self):
@@ -1038,43 +1317,49 @@ class backgroundTasks(commands.Cog):
 
         
 if __name__ =='__main__':
-    bot.db = db.PoeDB(ro=True)
-    bot.conn = sqlite3.connect('announce.sqlitedb')
-    bot.cursor=bot.conn.cursor()
-    bot.cursor.execute('''CREATE TABLE IF NOT EXISTS announce
+    bot.db = db.AsyncPoeDB()
+    # create tables up front, everything after this goes through bot.sql
+    conn = sqlite3.connect('announce.sqlitedb')
+    cursor = conn.cursor()
+    cursor.execute('''CREATE TABLE IF NOT EXISTS announce
              (channel int,
              type text,
              PRIMARY KEY (channel,type))''')
-    bot.cursor.execute('''CREATE TABLE IF NOT EXISTS forum_announcements
+    cursor.execute('''CREATE TABLE IF NOT EXISTS forum_announcements
              (title text,
              url text,
              threadnum text PRIMARY KEY)''')
-    bot.cursor.execute('''CREATE TABLE IF NOT EXISTS patch_notes
+    cursor.execute('''CREATE TABLE IF NOT EXISTS patch_notes
              (title text,
              url text,
              threadnum text PRIMARY KEY)''')
-    bot.cursor.execute('''CREATE TABLE IF NOT EXISTS daily_deals
+    cursor.execute('''CREATE TABLE IF NOT EXISTS daily_deals
              (title text,
              img_url text,
              hash text PRIMARY KEY)''')
-    bot.cursor.execute('''CREATE TABLE IF NOT EXISTS daily_labs
+    cursor.execute('''CREATE TABLE IF NOT EXISTS daily_labs
              (date text,
              diff text,
              img_url text,
              PRIMARY KEY (date,diff))''')
-    bot.cursor.execute('''CREATE TABLE IF NOT EXISTS regexp_filters
+    cursor.execute('''CREATE TABLE IF NOT EXISTS regexp_filters
              (channel int,
              type text,
              regexp text,
              PRIMARY KEY (channel,type))''')
     try:
-        bot.cursor.execute('''ALTER TABLE daily_deals ADD COLUMN end_date real''')
+        cursor.execute('''ALTER TABLE daily_deals ADD COLUMN end_date real''')
     except sqlite3.OperationalError:
         pass
-    bot.cursor.execute('''CREATE TABLE IF NOT EXISTS pricecheck
+    cursor.execute('''CREATE TABLE IF NOT EXISTS pricecheck
              (channel int PRIMARY KEY,
              league text)''')
-    bot.conn.commit()
+    conn.commit()
+    conn.close()
+    bot.sql = db.AsyncSQLite('announce.sqlitedb')
+
+    bot.settings = db.ChannelSettings(bot.sql)
+    bot.announcements = fanout.AnnouncementQueue(bot.send_to_channel)
 
     async def load_extensions():
         await bot.add_cog(Alerts())
@@ -1087,6 +1372,8 @@ if __name__ =='__main__':
     async def main():
         async with bot:
             await load_extensions()
+            # after the extensions so cog-owned tables (timezones) exist
+            await bot.settings.load()
             with open('token','r') as f:
                 await bot.start(f.read())
     asyncio.run(main())
@@ -1,9 +1,9 @@
 from discord.ext import commands,tasks
 from discord import Embed
 from urllib.parse import urlparse,urlunparse,parse_qsl,urlencode
-import requests
-import sqlite3
 import asyncio
+import db
+import ratelimit
 RESIN_CAP = 160
 RESIN_REGEN_IN_MINUTES = 8
 SMALLEST_SPENDABLE_RESIN = 40 # used for -resin reset
@@ -12,14 +12,15 @@ class GenshinTools(commands.Cog, name='Genshin Tools'):
 
     def __init__(self, bot):
         self.bot = bot
-        self.conn = sqlite3.connect('resin.sqlitedb')
-        self.cursor = self.conn.cursor()
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS resin
+        self.sql = db.AsyncSQLite('resin.sqlitedb')
+        
+    async def cog_load(self):
+        await self.sql.execute('''CREATE TABLE IF NOT EXISTS resin
              (user_id int,
              amount int,
              timestamp real,
              PRIMARY KEY (user_id))''') 
-        self.cursor.execute('''CREATE TABLE IF NOT EXISTS pity_rate_limit
+        await self.sql.execute('''CREATE TABLE IF NOT EXISTS pity_rate_limit
              (user_id int,
              last_request int,
              PRIMARY KEY (user_id))''')
@@ -27,6 +28,7 @@ class GenshinTools(commands.Cog, name='Genshin Tools'):
         
     def cog_unload(self):
         self.resinalert.cancel()
+        self.sql.close()
         
     @commands.command(hidden=True)
     async def resin(self, ctx, amount=None):
@@ -36,19 +38,16 @@ class GenshinTools(commands.Cog, name='Genshin Tools'):
             try:
                 assert int(amount)<=RESIN_CAP
                 if int(amount)<0:
-                    self.cursor.execute(''' UPDATE resin set amount=amount+? where user_id=?''',(int(amount),ctx.author.id,))
+                    await self.sql.execute(''' UPDATE resin set amount=amount+? where user_id=?''',(int(amount),ctx.author.id,))
                 else:
-                    self.cursor.execute(''' REPLACE INTO resin (user_id,amount,timestamp)  VALUES (?,?,julianday('now')) ''',(ctx.author.id,int(amount)))
-                self.conn.commit()
+                    await self.sql.execute(''' REPLACE INTO resin (user_id,amount,timestamp)  VALUES (?,?,julianday('now')) ''',(ctx.author.id,int(amount)))
             except:
                 if amount.lower() == 'reset':
-                    self.cursor.execute('''update resin set amount=amount-cast(((julianday('now')-timestamp)/(?/(24.*60)) + amount) / ? as int) * ? where user_id=?''',(RESIN_REGEN_IN_MINUTES,SMALLEST_SPENDABLE_RESIN,SMALLEST_SPENDABLE_RESIN,ctx.author.id,))
-                    self.conn.commit()
+                    await self.sql.execute('''update resin set amount=amount-cast(((julianday('now')-timestamp)/(?/(24.*60)) + amount) / ? as int) * ? where user_id=?''',(RESIN_REGEN_IN_MINUTES,SMALLEST_SPENDABLE_RESIN,SMALLEST_SPENDABLE_RESIN,ctx.author.id,))
                 else:
                     await self.bot.send_message(ctx.message.channel,'Invalid resin amount.')
                     return
-        self.cursor.execute(''' SELECT round((julianday('now')-timestamp)/(?/(24.*60))-.5) + amount from resin WHERE user_id=?''',(RESIN_REGEN_IN_MINUTES,ctx.author.id,))
-        res = self.cursor.fetchone()
+        res = await self.sql.fetchone(''' SELECT round((julianday('now')-timestamp)/(?/(24.*60))-.5) + amount from resin WHERE user_id=?''',(RESIN_REGEN_IN_MINUTES,ctx.author.id,))
         if not res:
             await self.bot.send_message(ctx.message.channel,'Set resin amount first with -resin <amount>')
             return
@@ -84,7 +83,7 @@ class GenshinTools(commands.Cog, name='Genshin Tools'):
         loop = asyncio.get_event_loop()
         while wishlist and (pity4==None or pity5==None) and wishcount < 90:
             qs.update({'end_id': last_id, 'page': current_page})
-            r = await loop.run_in_executor(None, requests.get, urlunparse(parsedUrl._replace(query=urlencode(qs))))
+            r = await loop.run_in_executor(None, ratelimit.get, urlunparse(parsedUrl._replace(query=urlencode(qs))))
             if r.status_code == 200:
                 js = r.json()
                 if js['retcode'] == 0:
@@ -105,7 +104,6 @@ class GenshinTools(commands.Cog, name='Genshin Tools'):
             if not wishlist:
                 break
             last_id = wishlist[-1]['id']
-            await asyncio.sleep(1)
         if pity4 == None:
             pity4 = wishcount
         if pity5 == None:
@@ -132,12 +130,10 @@ class GenshinTools(commands.Cog, name='Genshin Tools'):
             await self.bot.send_failure_message(ctx.message.channel,'```<feedback_url> is not a valid url.```')
             return
         async with ctx.typing():
-            r = self.cursor.execute('''SELECT 1 FROM pity_rate_limit WHERE (julianday('now')-last_request < 1./24/60/2) AND user_id=?''',(ctx.author.id,))
-            if r.fetchone():
+            if await self.sql.fetchone('''SELECT 1 FROM pity_rate_limit WHERE (julianday('now')-last_request < 1./24/60/2) AND user_id=?''',(ctx.author.id,)):
                 await self.bot.send_failure_message(ctx.message.channel,'```Too many requests in a short period, please try again later.```')
                 return
-            self.cursor.execute('''REPLACE into pity_rate_limit (user_id, last_request) VALUES (?, julianday('now'))''',(ctx.author.id,))
-            self.conn.commit()
+            await self.sql.execute('''REPLACE into pity_rate_limit (user_id, last_request) VALUES (?, julianday('now'))''',(ctx.author.id,))
             e = await self.getPityEmbed(feedback_url, banner)
             if not e:
                 await self.bot.send_failure_message(ctx.message.channel,'```Failed to fetch wish history.```')
@@ -146,8 +142,8 @@ class GenshinTools(commands.Cog, name='Genshin Tools'):
         
     @tasks.loop(seconds=60*RESIN_REGEN_IN_MINUTES)
     async def resinalert(self):
-        r = self.cursor.execute('''SELECT user_id FROM resin WHERE round((julianday('now')-timestamp)/(?/(24.*60))-.5) + amount = ?''',(RESIN_REGEN_IN_MINUTES,RESIN_CAP))
-        for row in r.fetchall():
+        r = await self.sql.fetchall('''SELECT user_id FROM resin WHERE round((julianday('now')-timestamp)/(?/(24.*60))-.5) + amount = ?''',(RESIN_REGEN_IN_MINUTES,RESIN_CAP))
+        for row in r:
             try:
                 user = await self.bot.fetch_user(row[0])
                 dm_channel = await user.create_dm()
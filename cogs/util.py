@@ -5,10 +5,14 @@ from dateparser.utils import localize_timezone
 import datetime
 import re
 import sys
+import asyncio
+import heapq
+import time
 from pytz import UnknownTimeZoneError
 sys.path.append("..") # Adds higher directory to python modules path.
 from bot import admin_or_dm,PRIVATE_CHANNEL
 DISCORD_PIN_LIMIT = 50
+REMINDER_RETRY = 60 # seconds until a reminder that could not be sent is tried again
 def parse_longest_substr_time(txt: str, settings: dict):
     dt, msg = None, txt
     tokens = re.split('(\s)', txt)
@@ -31,33 +35,75 @@ def parse_longest_substr_time(txt: str, settings: dict):
 class Utility(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        # (unix time, id) of every pending reminder, the loop sleeps until the first one is due
+        self._due = []
+        self._wakeup = asyncio.Event()
         self.reminders.start()
         
     def cog_unload(self):
         self.reminders.cancel()
 
-    @tasks.loop(seconds=5.0)
+    @tasks.loop()
     async def reminders(self):
-        r=self.bot.cursor.execute('''SELECT creator,role,channel,server,datetime,message FROM reminders WHERE datetime <= datetime('now')''')
-        for row in r.fetchall():
-            'announce and delete.'
+        ''' waits for the next reminder (or a new one being added), then delivers everything that is due '''
+        self._wakeup.clear()
+        delay = self._due[0][0] - time.time() if self._due else None
+        if delay is None or delay > 0:
             try:
-                ch_id = self.bot.get_channel(row[2]) 
-                if not ch_id:
-                    ch_id = await self.bot.fetch_channel(row[2])
-                await self.bot.send_message(ch_id, '<@{}> {}'.format(row[0],row[5]),code_block=False)
-            except Exception as e:
-                'channel missing or bot is blocked'
-            finally:
-                try:
-                    self.bot.cursor.execute('DELETE FROM reminders WHERE creator = ? and role = ? and channel = ? and server = ? and datetime = ? and message = ?', row)
-                    self.bot.conn.commit()
-                except:
-                    pass
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            return
+        now = time.time()
+        due = []
+        while self._due and self._due[0][0] <= now:
+            due.append(heapq.heappop(self._due)[1])
+        try:
+            # reminders deleted in the meantime are simply not found here
+            r = await self.bot.sql.fetchall('SELECT id,creator,channel,message FROM reminders WHERE id IN ({})'.format(','.join('?'*len(due))),due)
+            sent = await asyncio.gather(*[self._remind(*row[1:]) for row in r])
+            retry = [row[0] for row, ok in zip(r, sent) if not ok]
+            done = [id for id in due if id not in retry]
+            await self.bot.sql.execute('DELETE FROM reminders WHERE id IN ({})'.format(','.join('?'*len(done))),done)
+        except Exception as e:
+            print('error delivering reminders %r: %r'%(due,e))
+            # their rows are still there, so keep them in the heap too
+            retry = due
+        for id in retry:
+            heapq.heappush(self._due, (now + REMINDER_RETRY, id))
+
+    async def _remind(self, creator, channel, message):
+        ''' returns False if the reminder should be tried again later '''
+        try:
+            ch = self.bot.get_channel(channel)
+            if not ch:
+                ch = await self.bot.fetch_channel(channel)
+            await self.bot.send_message(ch, '<@{}> {}'.format(creator,message),code_block=False)
+        except (discord.NotFound, discord.Forbidden):
+            pass # channel missing or bot is blocked, it will never arrive
+        except Exception as e:
+            print('error sending reminder to %s: %r'%(channel,e))
+            return False
+        return True
+
+    def _schedule(self, id, timestamp):
+        heapq.heappush(self._due, (timestamp, id))
+        self._wakeup.set()
+
+    def _unschedule(self, id):
+        # only on -reminder delete, rare enough that rebuilding the heap is fine
+        self._due = [entry for entry in self._due if entry[1] != id]
+        heapq.heapify(self._due)
+        self._wakeup.set()
 
     @reminders.before_loop
     async def before_run(self):
         await self.bot.wait_until_ready()
+        r = await self.bot.sql.fetchall('''SELECT id, (julianday(datetime)-2440587.5)*86400.0 FROM reminders WHERE julianday(datetime) IS NOT NULL''')
+        # a reminder added while this ran is already in the heap, and maybe in r too
+        scheduled = {id for _, id in self._due}
+        self._due.extend((timestamp, id) for id, timestamp in r if id not in scheduled)
+        heapq.heapify(self._due)
 
     @commands.Cog.listener()
     async def on_guild_channel_pins_update(self, chan, last_pin):
@@ -67,8 +113,7 @@ class Utility(commands.Cog):
             'missing permissions'
             return
         if len(pins) >= DISCORD_PIN_LIMIT:
-            r=self.bot.cursor.execute('SELECT dest FROM pins WHERE source=?',(chan.id,))
-            dest = r.fetchone()
+            dest = await self.bot.sql.fetchone('SELECT dest FROM pins WHERE source=?',(chan.id,))
             if dest:
                 pin_channel=self.bot.get_channel(dest[0])
                 if pin_channel and self._pin_perm_check(chan.guild, chan, pin_channel):
@@ -85,8 +130,7 @@ class Utility(commands.Cog):
             assert int(count)>0
         except:
             raise commands.BadArgument()
-        r=self.bot.cursor.execute('SELECT dest FROM pins WHERE source=?',(ctx.message.channel.id,))
-        dest = r.fetchone()
+        dest = await self.bot.sql.fetchone('SELECT dest FROM pins WHERE source=?',(ctx.message.channel.id,))
         if not dest:
             await self.bot.send_message(ctx.message.channel, 'No destination channel set for pins, use -pin set <channel>')
             return
@@ -110,8 +154,7 @@ class Utility(commands.Cog):
             just_id = channel[2:-1]
             ch = self.bot.get_channel(int(just_id))
             if ch and self._pin_perm_check(ctx.message.guild,ctx.message.channel,ch):
-                self.bot.cursor.execute('REPLACE INTO pins(source,dest) VALUES(?,?)',(ctx.message.channel.id,just_id))
-                self.bot.conn.commit()
+                await self.bot.sql.execute('REPLACE INTO pins(source,dest) VALUES(?,?)',(ctx.message.channel.id,just_id))
                 await self.bot.send_message(ctx.message.channel, 'Set pin destination for {} to {}'.format(ctx.message.channel.mention,ch.mention),code_block=False)
                 return
             else:
@@ -160,12 +203,11 @@ class Utility(commands.Cog):
             return
         server_id = ctx.message.guild and ctx.message.guild.id or ctx.message.channel.id
         subcmd = query[0]
-        r = self.bot.cursor.execute('SELECT timezone from timezones where server=?',(server_id,)).fetchone()
-        settings = {'TIMEZONE':(r and r[0]) or 'UTC', 'TO_TIMEZONE':'UTC', 'PREFER_DATES_FROM': 'future'}
-        disp_settings = {'TO_TIMEZONE':(r and r[0]) or 'UTC', 'TIMEZONE':'UTC', 'PREFER_DATES_FROM': 'future'}
+        timezone = self.bot.settings.timezone(server_id)
+        settings = {'TIMEZONE':timezone, 'TO_TIMEZONE':'UTC', 'PREFER_DATES_FROM': 'future'}
+        disp_settings = {'TO_TIMEZONE':timezone, 'TIMEZONE':'UTC', 'PREFER_DATES_FROM': 'future'}
         if subcmd in ('list','-l'):
-            r = self.bot.cursor.execute('SELECT message, strftime("%s",datetime) FROM reminders where creator = ? and server = ? ORDER by datetime ASC',(ctx.message.author.id,server_id))
-            res = r.fetchall()
+            res = await self.bot.sql.fetchall('SELECT message, strftime("%s",datetime) FROM reminders where creator = ? and server = ? ORDER by datetime ASC',(ctx.message.author.id,server_id))
             if not res:
                 await self.bot.send_message(ctx.message.channel, 'You have 0 reminders.')
                 return
@@ -181,15 +223,14 @@ class Utility(commands.Cog):
             if reminder_index < 0:
                 await self.bot.send_message(ctx.message.channel, 'Invalid index. Use -reminder list to see all reminders.')
                 return
-            r = self.bot.cursor.execute('SELECT creator,role,channel,server,datetime,message FROM reminders where creator = ? and server = ? ORDER by datetime ASC',(ctx.message.author.id,server_id))
-            res = r.fetchall()
+            res = await self.bot.sql.fetchall('SELECT id FROM reminders where creator = ? and server = ? ORDER by datetime ASC',(ctx.message.author.id,server_id))
             try:
-                res[reminder_index]
+                id, = res[reminder_index]
             except IndexError:
                 await self.bot.send_message(ctx.message.channel, 'Invalid index. Use -reminder list to see all reminders.')
                 return
-            self.bot.cursor.execute('DELETE FROM reminders WHERE creator = ? and role = ? and channel = ? and server = ? and datetime = ? and message = ?', res[reminder_index])
-            self.bot.conn.commit()
+            await self.bot.sql.execute('DELETE FROM reminders WHERE id = ?', (id,))
+            self._unschedule(id)
             await self.bot.send_message(ctx.message.channel, 'Reminder deleted.')
         elif subcmd in ('timezone','tz'):
             if len(query)<2:
@@ -202,8 +243,7 @@ class Utility(commands.Cog):
             if not self._is_valid_tz(tz):
                 await self.bot.send_message(ctx.message.channel, 'Invalid timezone.')
                 return
-            self.bot.cursor.execute('REPLACE INTO timezones(server,timezone) VALUES(?,?)',(server_id,tz))
-            self.bot.conn.commit()
+            await self.bot.settings.set_timezone(server_id,tz)
             await self.bot.send_message(ctx.message.channel, 'Server timezone set to "{}"'.format(tz))
         # elif subcmd is role or channel, this isnt that useful, maybe implement later.
         # elif re.match('^@&.*$',subcmd):
@@ -224,8 +264,8 @@ class Utility(commands.Cog):
             if date <= datetime.datetime.now(datetime.timezone.utc):
                 await self.bot.send_message(ctx.message.channel, 'Given date (<t:{}:f>) has already passed, try being more specific.'.format(int(date.timestamp())),code_block=False)
                 return
-            self.bot.cursor.execute('REPLACE INTO reminders(creator,server,channel,datetime,message) VALUES(?,?,?,?,?)',(ctx.message.author.id,server_id,ctx.message.channel.id,date,msg))
-            self.bot.conn.commit()
+            id = await self.bot.sql.insert('INSERT INTO reminders(creator,server,channel,datetime,message) VALUES(?,?,?,?,?)',(ctx.message.author.id,server_id,ctx.message.channel.id,date,msg))
+            self._schedule(id, date.timestamp())
             await self.bot.send_message(ctx.message.channel, 'Reminder set for <t:{}:f>'.format(int(date.timestamp())),code_block = False)
         else:
             await self.bot.send_message(ctx.message.channel, helpmsg)
@@ -263,20 +303,37 @@ class Utility(commands.Cog):
         return e
 
 async def setup(bot):
-    bot.cursor.execute('''CREATE TABLE IF NOT EXISTS pins
+    await bot.sql.execute('''CREATE TABLE IF NOT EXISTS pins
              (source int PRIMARY KEY,
              dest int)''')
-    bot.cursor.execute('''CREATE TABLE IF NOT EXISTS reminders
-             (creator int,
+    await bot.sql.execute('''CREATE TABLE IF NOT EXISTS reminders
+             (id INTEGER PRIMARY KEY,
+             creator int,
              role int DEFAULT 0,
              channel int DEFAULT 0,
              server int DEFAULT 0,
              datetime real,
              message text,
-             interval int DEFAULT 0,
-             PRIMARY KEY (creator,server,message,datetime,channel,role))''')
-    bot.cursor.execute('''CREATE TABLE IF NOT EXISTS timezones
+             interval int DEFAULT 0)''')
+    if 'id' not in [col[1] for col in await bot.sql.fetchall('PRAGMA table_info(reminders)')]:
+        # older tables were keyed by every column, so a delete had to match all of them
+        await bot.sql.executescript('''BEGIN;
+            CREATE TABLE reminders_new
+                 (id INTEGER PRIMARY KEY,
+                 creator int,
+                 role int DEFAULT 0,
+                 channel int DEFAULT 0,
+                 server int DEFAULT 0,
+                 datetime real,
+                 message text,
+                 interval int DEFAULT 0);
+            INSERT INTO reminders_new (creator,role,channel,server,datetime,message,interval)
+                SELECT creator,role,channel,server,datetime,message,interval FROM reminders;
+            DROP TABLE reminders;
+            ALTER TABLE reminders_new RENAME TO reminders;
+            COMMIT;''')
+    await bot.sql.execute('''CREATE INDEX IF NOT EXISTS reminders_creator ON reminders (creator,server,datetime)''')
+    await bot.sql.execute('''CREATE TABLE IF NOT EXISTS timezones
              (server int PRIMARY KEY,
              timezone text DEFAULT "UTC")''')
-    bot.conn.commit()
     await bot.add_cog(Utility(bot))
\ No newline at end of file
@@ -6,154 +6,564 @@ import re
 import json
 import html
 import time
+import datetime
 import os
+import fcntl
+import contextlib
+import asyncio
+import threading
+import functools
+import inspect
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import cloudscraper
+import ratelimit
+import nameindex
 
 abspath = os.path.abspath(__file__)
 dname = os.path.dirname(abspath)
 os.chdir(dname)
 VALID_PC_LEAGUES = ['tmpStandard', 'tmpHardcore', 'eventStandard', 'eventHardcore', 'Standard', 'Hardcore']
+# currencies other prices are converted into, see PoeDB.exchange_rates
+RATE_ANCHORS = ('Divine Orb', 'Exalted Orb', 'Mirror of Kalandra')
+# table: columns covered by its fts5 shadow index (<table>_fts)
+FTS_TABLES = {
+    'unique_items': ('expl', 'impl'),
+    'passive_skills': ('desc',),
+}
+
+# wiki tables: column holding the wiki page name, used by incremental syncs
+WIKI_PAGE_COLUMNS = {'unique_items': 'name', 'skill_gems': 'name', 'passive_skills': 'pagename'}
+NINJA_TABLES = ('ninja_data', 'ninja_currency_data')
+# price_history.kind for each ninja table
+HISTORY_KINDS = {'ninja_data': 0, 'ninja_currency_data': 1}
+# (age in seconds, bucket size in seconds): points older than age are averaged into buckets of that size
+HISTORY_RESOLUTION = ((60*60*24*2, 60*60), (60*60*24*30, 60*60*24))
+HISTORY_RETENTION = 60*60*24*365
+# not compared by PoeDB.apply_changes, they only change when another column does
+DERIVED_COLUMNS = ('base_name', 'timestamp')
+# tables with a base_name column, used to join wiki data to poe.ninja data without calling into python per row
+NORMALIZED_NAME_TABLES = ('unique_items', 'skill_gems', 'passive_skills', 'ninja_data')
+
+def normalize_name(name):
+    '''casefold and strip variant suffixes ("Item (Evasion)") and punctuation from a name.'''
+    if name is None:
+        return None
+    name = re.sub(r' ?\([^)]*\)','',name).casefold()
+    return ' '.join(re.sub(r'[^\w\s]','',name).split())
+
+def fts_query(keywords):
+    '''
+    Build an fts5 MATCH expression requiring ALL keywords.
+
+    Each keyword becomes a quoted phrase with prefix matching, so "crit multi" matches "Critical Strike Multiplier".
+    Returns None if no keyword contains any searchable characters.
+    '''
+    phrases = []
+    for keyword in keywords:
+        tokens = re.findall(r'\w+', keyword)
+        if tokens:
+            phrases.append('"{}"*'.format(' '.join(tokens)))
+    if not phrases:
+        return None
+    return ' AND '.join(phrases)
+
+def mod_query(keywords):
+    '''
+    Split -um keywords into words of a mod template and a roll range.
+
+    The first number ("80", "+80", "80%", "10-20") is the range, everything else has to appear in the template, so
+    "80 maximum life" finds uniques that can roll at least 80 on "+# to maximum Life". Returns (words, low, high),
+    low and high are None when not given.
+    '''
+    words, low, high = [], None, None
+    for keyword in keywords:
+        number = re.fullmatch(r'\+?(-?\d+(?:\.\d+)?)%?(?:-(-?\d+(?:\.\d+)?)%?)?', keyword)
+        if number and low is None:
+            low = float(number.group(1))
+            high = number.group(2) and float(number.group(2))
+        else:
+            words.extend(re.findall(r'[^\W_]+', keyword))
+    return words, low, high
+
+Page = namedtuple('Page', 'rows total cursor')
+Page.__doc__ = '''
+One page of search results: rows, the number of results over all pages, and the cursor to pass back to the
+search for the next page (None on the last page).
+'''
+
+class ResultCache:
+    '''
+    Thread-safe LRU cache with a TTL for PoeDB lookups, shared by all reader threads.
+
+    Entries are tied to the data generation they were computed from, the first lookup after a new snapshot is
+    published empties the cache. hits, misses and evictions are counted so the size can be tuned.
+    '''
+    def __init__(self,maxsize=512,ttl=60*60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._generation = None
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check_generation(self, generation):
+        if generation != self._generation:
+            if self._data:
+                self.invalidations += 1
+            self._data.clear()
+            self._generation = generation
+
+    def get(self, key, generation):
+        ''' returns (found, value) '''
+        with self._lock:
+            self._check_generation(generation)
+            entry = self._data.get(key)
+            if entry is not None:
+                if time.monotonic() - entry[0] < self.ttl:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, entry[1]
+                del self._data[key]
+                self.evictions += 1
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value, generation):
+        with self._lock:
+            self._check_generation(generation)
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+def file_id(path):
+    ''' identifies one published version of a database file (see snapshot) '''
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime_ns)
+
+def _normalize_search(value):
+    if isinstance(value, str):
+        return ' '.join(value.lower().split())
+    return tuple(_normalize_search(v) for v in value)
+
+def cached(search_arg):
+    '''
+    Cache a PoeDB lookup in self.cache (if set), keyed on the method, its arguments and the data generation.
+
+    search_arg is the name of the user supplied search argument, it is lowercased and whitespace normalized for the key.
+    '''
+    def decorator(method):
+        signature = inspect.signature(method)
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.cache is None:
+                return method(self, *args, **kwargs)
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            key = (method.__name__,) + tuple(_normalize_search(v) if k == search_arg else v for k,v in bound.arguments.items() if k != 'self')
+            found, value = self.cache.get(key, self._file_id)
+            if not found:
+                value = method(self, *args, **kwargs)
+                self.cache.put(key, value, self._file_id)
+            if isinstance(value, Page):
+                return value._replace(rows=list(value.rows))
+            return list(value)
+        return wrapper
+    return decorator
+
+# full unique_items rows (with prices) for PoeDB._fill
+UNIQUE_PAGE_QUERY = '''SELECT unique_items.*, ninja_data.*, unique_items.name AS _name FROM unique_items
+        LEFT JOIN ninja_data ON ninja_data.league=? AND ninja_data.base_name=unique_items.base_name
+        WHERE unique_items.name IN ({})
+        GROUP BY unique_items.name'''
+
 class PoeDB:
 
-    def __init__(self,ro=False,dbfile="poedb.sqlite"):
+    def __init__(self,ro=False,dbfile="poedb.sqlite",cache=None):
+        ''' cache is an optional ResultCache for lookups, only used with ro=True '''
         self.db=dbfile
         self.ro = ro
+        self.cache = cache if ro else None
+        self.generation = 0
         self._connect(ro)
-        self._create_tables()
+        if not ro:
+            # readers run on whatever db.py published last, it is migrated by the next ingest instead
+            self._create_tables()
         self.scraper = cloudscraper.create_scraper()
     
     def _connect(self, ro):
         if ro:
+            self._file_id = file_id(self.db)
             self.conn=sqlite3.connect('file:%s?mode=ro'%self.db, uri=True, detect_types=sqlite3.PARSE_DECLTYPES)
         else:
             self.conn=sqlite3.connect(self.db, detect_types=sqlite3.PARSE_DECLTYPES)
         self.conn.row_factory = sqlite3.Row
-        def _trim_variant(itemname):
-            return re.sub(r' ?\([^)]*\)','',itemname)
-        self.conn.create_function('trim_variant',1,_trim_variant)
+        self.conn.create_function('normalize_name',1,normalize_name,deterministic=True)
         self.cursor=self.conn.cursor()
         # self.cursor.execute('pragma short_column_names=OFF;')
         # self.cursor.execute('PRAGMA full_column_names=ON;')
     
+    def check_generation(self):
+        '''
+        Reopen a read-only connection if db.py has published a new snapshot since it was opened.
+
+        Call this between commands, returns True if the data generation changed.
+        '''
+        if not self.ro or file_id(self.db) == self._file_id:
+            return False
+        self.conn.close()
+        self._connect(self.ro)
+        self.generation += 1
+        return True
+
     def _create_tables(self):
         field_names = scrape_poe_wiki.UNIQUE_ITEM_PROPERTY_MAPPING.values()
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS unique_items
-                 (thumbnail_url text, {}, PRIMARY KEY (name))'''.format(','.join([name+' text' for name in field_names])))
+                 (thumbnail_url text, base_name text, {}, PRIMARY KEY (name))'''.format(','.join([name+' text' for name in field_names])))
         field_names = scrape_poe_wiki.SKILL_GEM_PROPERTY_MAPPING.values()
         levelmax_field_names = list(scrape_poe_wiki.SKILL_GEM_VARIABLE_FIELDS.values()) + list(scrape_poe_wiki.GEM_LEVELS_VARIABLE_FIELDS.values())
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS skill_gems
-                 (thumbnail_url text, skill_id_group text, {}, {}, PRIMARY KEY (name))'''.format(','.join([name+' text' for name in field_names]),','.join([name+'_max text' for name in levelmax_field_names])))
+                 (thumbnail_url text, skill_id_group text, base_name text, {}, {}, PRIMARY KEY (name))'''.format(','.join([name+' text' for name in field_names]),','.join([name+'_max text' for name in levelmax_field_names])))
         field_names = scrape_poe_wiki.SKILL_QUALITY_PROPERTY_MAPPING.values()
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS skill_quality
                  ({}, PRIMARY KEY (name,q_type))'''.format(','.join([name+' text' for name in field_names])))
         field_names = scrape_poe_wiki.PASSIVE_SKILLS_PROPERTY_MAPPING.values()
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS passive_skills
-                 (thumbnail_url text, {}, PRIMARY KEY (pagename, name))'''.format(','.join([name + (' integer' if name.startswith('is_') else ' text') for name in field_names])))
+                 (thumbnail_url text, base_name text, {}, PRIMARY KEY (pagename, name))'''.format(','.join([name + (' integer' if name.startswith('is_') else ' text') for name in field_names])))
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS event_times
                  (id text primary key, startAt timestamp, endAt timestamp, url text)''')
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS sync_state
+                 (key text primary key, value text)''')
+        # one point per price change, see record_history/compact_history
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS price_history
+                 (kind integer, id integer, league text, bucket integer, chaosValue real, divineValue real,
+                 PRIMARY KEY (kind, id, league, bucket)) WITHOUT ROWID''')
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS ninja_data
-                 (id integer, name text, icon text, chaosValue real, exaltedValue real, divineValue real, itemClass integer, league text, PRIMARY KEY (id,league))''')
+                 (id integer, name text, base_name text, icon text, chaosValue real, exaltedValue real, divineValue real, itemClass integer, league text, category text, PRIMARY KEY (id,league))''')
         self.cursor.execute('''CREATE TABLE IF NOT EXISTS ninja_currency_data
-                 (id integer, name text, icon text, chaosValue real, league text, PRIMARY KEY (id,league))''')
-        # add timestamp triggers to poe.ninja tables
+                 (id integer, name text, icon text, chaosValue real, league text, category text, PRIMARY KEY (id,league))''')
+        # add timestamp column to poe.ninja tables, it is set by add_items_async
         for table in ('ninja_currency_data','ninja_data'):
             try:
                 self.cursor.execute(f'''ALTER TABLE {table} ADD COLUMN timestamp timestamp DEFAULT 0''')
                 self.cursor.execute(f'''UPDATE {table} SET timestamp = datetime('now') where timestamp = 0''')
             except sqlite3.OperationalError:
                 pass
+            # these used to stamp rows one update at a time (across every league)
             try:
-                self.cursor.execute(f'''CREATE TRIGGER {table}_inserttime AFTER INSERT ON {table}
-                begin
-                update {table} set timestamp=datetime('now') where id = new.id;
-                end''')
+                self.cursor.execute(f'''DROP TRIGGER IF EXISTS {table}_inserttime''')
+                self.cursor.execute(f'''DROP TRIGGER IF EXISTS {table}_updatetime''')
             except sqlite3.OperationalError:
                 pass
+        try:
+            self.cursor.execute(f'''ALTER TABLE ninja_data ADD COLUMN divineValue real''')
+        except sqlite3.OperationalError:
+            pass
+        # poe.ninja type a row was fetched from, apply_changes diffs one (league, category) at a time
+        for table in NINJA_TABLES:
             try:
-                self.cursor.execute(f'''CREATE TRIGGER {table}_updatetime AFTER UPDATE ON {table}
-                begin
-                update {table} set timestamp=datetime('now') where id = old.id;
-                end''')
+                self.cursor.execute(f'''ALTER TABLE {table} ADD COLUMN category text''')
             except sqlite3.OperationalError:
                 pass
         try:
-            self.cursor.execute(f'''ALTER TABLE ninja_data ADD COLUMN divineValue real''')
+            self.cursor.execute(f'''ALTER TABLE skill_gems ADD COLUMN skill_id_group text''')
         except sqlite3.OperationalError:
             pass
+        for table in NORMALIZED_NAME_TABLES:
+            try:
+                self.cursor.execute(f'''ALTER TABLE {table} ADD COLUMN base_name text''')
+                self.cursor.execute(f'''UPDATE {table} SET base_name = normalize_name(name)''')
+            except sqlite3.OperationalError:
+                pass
+        # covers both the price join and the fallback_icon lookup in get_data
         try:
-            self.cursor.execute(f'''ALTER TABLE skill_gems ADD COLUMN skill_id_group text''')
+            self.cursor.execute('''DROP INDEX IF EXISTS ninja_data_name''')
+            self.cursor.execute('''CREATE INDEX IF NOT EXISTS ninja_data_base_name ON ninja_data (league, base_name, icon)''')
+        except sqlite3.OperationalError:
+            pass
+        # full-text indexes for keyword searches (-us, -ns), rebuilt from the content table after every ingest
+        for table,columns in FTS_TABLES.items():
+            try:
+                self.cursor.execute(f'''CREATE VIRTUAL TABLE {table}_fts USING fts5({', '.join(columns)}, content='{table}', content_rowid='rowid')''')
+                self._rebuild_fts(table)
+            except sqlite3.OperationalError:
+                pass
+        # unique item mods parsed into a template and roll range (scrape_poe_wiki.parse_mod) for -um
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS mod_templates
+                 (id integer primary key, template text unique)''')
+        try:
+            self.cursor.execute('''CREATE TABLE unique_mods
+                     (template_id integer, name text, implicit integer, minimum real, maximum real)''')
+            self.cursor.execute('''CREATE INDEX unique_mods_range ON unique_mods (template_id, maximum, minimum)''')
+            self.cursor.execute('''CREATE INDEX unique_mods_name ON unique_mods (name)''')
+            self._index_mods([dict(r) for r in self.cursor.execute('''SELECT name, impl, expl FROM unique_items''').fetchall()])
         except sqlite3.OperationalError:
             pass
         self.conn.commit()
 
+    def _rebuild_fts(self,table):
+        if table in FTS_TABLES:
+            self.cursor.execute(f'''INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')''')
+
     def add_item(self,data,table='unique_items'):
-        columns = ', '.join(data.keys())
-        placeholders = ', '.join(['?']*len(data.values()))
-        query = '''REPLACE INTO %s (%s) VALUES (%s)''' % (table, columns, placeholders)
-        self.cursor.execute(query, [v if v==None else html.unescape(str(v)) for v in list(data.values())])
-        self.conn.commit()
+        self.add_items_async((data,),table)
 
     def add_items_async(self,data,table='unique_items'):
-        self.cursor.execute('''CREATE TEMP TABLE {}_tmp AS SELECT * FROM {} LIMIT 0'''.format(table,table))
+        '''
+        Bulk REPLACE rows into a table using one prepared statement in a single transaction.
+
+        data is any iterable (a generator is fine) of dicts where keys are columns in the db, unknown keys are ignored.
+        '''
+        columns = self._columns(table)
+        query = '''REPLACE INTO {} ({}) VALUES ({})'''.format(table, ', '.join('"{}"'.format(c) for c in columns), ', '.join(['?']*len(columns)))
+        if table == 'unique_items':
+            data = list(data)
+        with self.conn:
+            self.cursor.executemany(query, self._rows(data, table, columns))
+            self._rebuild_fts(table)
+            if table == 'unique_items':
+                self._index_mods(data)
+
+    def _index_mods(self,items):
+        ''' replaces the unique_mods rows of these unique items, parses their mods if format_affixes has not '''
+        self.cursor.executemany('''DELETE FROM unique_mods WHERE name=?''',[(item['name'],) for item in items])
+        mods = [(item['name'],)+mod for item in items for mod in (item['mods'] if 'mods' in item else scrape_poe_wiki.item_mods(item))]
+        self.cursor.executemany('''INSERT OR IGNORE INTO mod_templates (template) VALUES (?)''',{(mod[2],) for mod in mods})
+        self.cursor.executemany('''INSERT INTO unique_mods (template_id, name, implicit, minimum, maximum)
+                SELECT id, ?, ?, ?, ? FROM mod_templates WHERE template=?''',
+                [(name, implicit, minimum, maximum, template) for name, implicit, template, minimum, maximum in mods])
+
+    def _columns(self,table):
+        return [r[1] for r in self.cursor.execute('''PRAGMA table_info({})'''.format(table))]
+
+    def _timestamp(self):
+        return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    def _rows(self,data,table,columns):
+        ''' the values add_items_async would store for each datum, in column order '''
+        timestamp = self._timestamp()
+        normalize = table in NORMALIZED_NAME_TABLES
         for datum in data:
-            columns = ', '.join(datum.keys())
-            placeholders = ', '.join(['?']*len(datum.values()))
-            query = '''REPLACE INTO {}_tmp ({}) VALUES ({})'''.format(table, columns, placeholders)
-            self.cursor.execute(query, [v if v==None else html.unescape(str(v)) for v in list(datum.values())])
-        self.cursor.execute('''REPLACE INTO {} SELECT * FROM {}_tmp'''.format(table,table))
-        self.cursor.execute('''DROP TABLE {}_tmp'''.format(table))
-        self.conn.commit()
+            if normalize:
+                datum['base_name'] = normalize_name(datum['name'])
+            datum['timestamp'] = timestamp
+            yield [html.unescape(v) if isinstance(v,str) and '&' in v else v for v in map(datum.get, columns)]
+
+    def apply_changes(self,data,table,league,category):
+        '''
+        Make the rows of one poe.ninja (league, category) in table match data, writing only what differs.
+
+        Rows are compared on every column except DERIVED_COLUMNS, new and changed rows are written (and
+        timestamped), rows missing from data are deleted. Returns (inserted, updated, deleted).
+        '''
+        columns = self._columns(table)
+        compared = [i for i,c in enumerate(columns) if c not in DERIVED_COLUMNS]
+        id_col = columns.index('id')
+        # ids and values are compared as text when they differ in type, sqlite column affinity turns '123' into 123
+        def same(a,b):
+            return a == b or (a is not None and b is not None and str(a) == str(b))
+        # rows from before the category column existed are matched by id and get their category on the next update
+        current = {str(r[id_col]): r for r in self.cursor.execute(f'''SELECT * FROM {table} WHERE league=? AND (category=? OR category IS NULL)''',(league,category))}
+        incoming = {}
+        for datum in data:
+            datum['category'] = category
+            incoming[str(datum['id'])] = datum
+        changed = []
+        inserted = 0
+        for row in self._rows(incoming.values(), table, columns):
+            old = current.get(str(row[id_col]))
+            if old is None:
+                inserted += 1
+            elif all(same(row[i], old[i]) for i in compared):
+                continue
+            changed.append(row)
+        deleted = [(r['id'],league) for i,r in current.items() if i not in incoming and r['category'] == category]
+        if changed or deleted:
+            query = '''REPLACE INTO {} ({}) VALUES ({})'''.format(table, ', '.join('"{}"'.format(c) for c in columns), ', '.join(['?']*len(columns)))
+            with self.conn:
+                self.cursor.executemany(query, changed)
+                self.cursor.executemany(f'''DELETE FROM {table} WHERE id=? AND league=?''', deleted)
+                self.record_history(table, [dict(zip(columns, row)) for row in changed])
+        return inserted, len(changed) - inserted, len(deleted)
+
+    def mark_fetched(self,table,league,category):
+        '''
+        Sets the timestamp of every row of one poe.ninja (league, category) to now.
+
+        apply_changes only writes rows that changed, but the embeds show timestamp as the time the price is from.
+        '''
+        with self.conn:
+            self.cursor.execute(f'''UPDATE {table} SET timestamp=? WHERE league=? AND category=?''',(self._timestamp(),league,category))
+
+    def drop_uncategorized(self,table,league):
+        '''
+        Deletes the rows of a league that still have no category, returns how many.
+
+        Rows from before the category column get one as soon as their poe.ninja type is applied, so once
+        every type of the table was applied in a run, the ones left over are no longer listed upstream.
+        '''
+        with self.conn:
+            return self.cursor.execute(f'''DELETE FROM {table} WHERE league=? AND category IS NULL''',(league,)).rowcount
+
+    def record_history(self,table,rows,when=None):
+        ''' adds a price_history point for each row (dicts with id, league, chaosValue and maybe divineValue) '''
+        bucket = int(when if when is not None else time.time())
+        kind = HISTORY_KINDS[table]
+        self.cursor.executemany('''REPLACE INTO price_history (kind,id,league,bucket,chaosValue,divineValue) VALUES (?,?,?,?,?,?)''',
+                                [(kind, r['id'], r['league'], bucket, r['chaosValue'], r.get('divineValue')) for r in rows])
+
+    def compact_history(self,now=None):
+        '''
+        Averages old price_history points into coarser buckets (HISTORY_RESOLUTION) and drops points
+        older than HISTORY_RETENTION. Returns the number of rows removed.
+        '''
+        now = int(now if now is not None else time.time())
+        before = self.cursor.execute('''SELECT COUNT(*) FROM price_history''').fetchone()[0]
+        with self.conn:
+            self.cursor.execute('''DELETE FROM price_history WHERE bucket < ?''',(now - HISTORY_RETENTION,))
+            for age,size in HISTORY_RESOLUTION:
+                # only whole buckets, a bucket that is still filling up is left alone
+                cutoff = (now - age) // size * size
+                self.cursor.execute('''CREATE TEMP TABLE history_rollup AS
+                    SELECT kind, id, league, bucket / ? * ? AS rolled, AVG(chaosValue) AS chaosValue, AVG(divineValue) AS divineValue
+                    FROM price_history WHERE bucket < ?
+                    GROUP BY kind, id, league, rolled
+                    HAVING COUNT(*) > 1 OR MIN(bucket) <> rolled''',(size, size, cutoff))
+                self.cursor.execute('''DELETE FROM price_history WHERE bucket < ? AND (kind, id, league, bucket / ? * ?) IN
+                    (SELECT kind, id, league, rolled FROM history_rollup)''',(cutoff, size, size))
+                self.cursor.execute('''INSERT INTO price_history (kind,id,league,bucket,chaosValue,divineValue)
+                    SELECT kind, id, league, rolled, chaosValue, divineValue FROM history_rollup''')
+                self.cursor.execute('''DROP TABLE history_rollup''')
+        return before - self.cursor.execute('''SELECT COUNT(*) FROM price_history''').fetchone()[0]
+
+    def price_history(self,table,id,league,since=0):
+        '''
+        [(unix time, chaosValue, divineValue), ...] oldest first.
+        includes the last point before since, which is the price at since as points are only added on changes.
+        '''
+        kind = HISTORY_KINDS[table]
+        return self.cursor.execute('''SELECT bucket, chaosValue, divineValue FROM price_history
+                WHERE kind=? AND id=? AND league=? AND bucket >= COALESCE(
+                    (SELECT MAX(bucket) FROM price_history WHERE kind=? AND id=? AND league=? AND bucket <= ?), ?)
+                ORDER BY bucket''',(kind, id, league, kind, id, league, since, since)).fetchall()
         
-    def get_data(self,tablename,searchname,league = None,limit = 9, search_by_baseitem = False):
+    def delete_pages(self,pages):
+        ''' removes every wiki row that came from one of these page names, returns the number of rows deleted '''
+        deleted = 0
+        with self.conn:
+            for table,column in WIKI_PAGE_COLUMNS.items():
+                self.cursor.executemany(f'''DELETE FROM {table} WHERE {column}=?''',[(p,) for p in pages])
+                deleted += self.cursor.rowcount
+                self._rebuild_fts(table)
+            self.cursor.executemany('''DELETE FROM unique_mods WHERE name=?''',[(p,) for p in pages])
+        return deleted
+
+    def get_sync_state(self,key):
+        r = self.cursor.execute('''SELECT value FROM sync_state WHERE key=?''',(key,)).fetchone()
+        return r and r[0]
+
+    def set_sync_state(self,key,value):
+        with self.conn:
+            self.cursor.execute('''REPLACE INTO sync_state (key,value) VALUES (?,?)''',(key,value))
+
+    def _paged(self,query,params,keys,cursor,limit):
+        '''
+        One Page of the rows of query (a SELECT without ORDER BY or LIMIT), ordered by the columns named in keys.
+
+        keys have to be unique together and are only compared ascending (select a negated value to sort descending).
+        Pages are seeked to with a row value comparison on keys instead of an OFFSET and sorted with LIMIT, so only
+        the rows of the page are ever turned into python objects. The total is only counted for the first page,
+        later pages have None.
+        '''
+        order = ', '.join(keys)
+        total = None
+        if cursor is None:
+            total = self.cursor.execute(f'''SELECT COUNT(*) FROM ({query})''', params).fetchone()[0]
+        seek = 'WHERE ({}) > ({})'.format(order, ', '.join('?'*len(keys))) if cursor else ''
+        rows = self.cursor.execute(f'''SELECT * FROM ({query}) {seek} ORDER BY {order} LIMIT ?''',
+                list(params) + list(cursor or ()) + [limit+1]).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        return Page(rows, total, tuple(rows[-1][k] for k in keys) if more else None)
+
+    def _fill(self,page,query,params,key='_name'):
+        '''
+        Swaps the (narrow) rows of a page for the full rows of the same results, so wide rows are only built for
+        the page. query has a {} where the IN list of key values goes and has to select the key column.
+        '''
+        if not page.rows:
+            return page
+        values = [r[key] for r in page.rows]
+        rows = {r[key]: r for r in self.cursor.execute(query.format(', '.join('?'*len(values))), list(params)+values)}
+        return page._replace(rows=[rows[v] for v in values if v in rows])
+
+    def _exact_first(self,page):
+        ''' narrows a page down to its first row if that is an exact name match (the _exact key is 0) '''
+        if page.total and page.total > 1 and page.rows[0]['_exact'] == 0:
+            return Page(page.rows[:1], 1, None)
+        return page
+
+    @cached('searchname')
+    def get_data(self,tablename,searchname,league = None,limit = 9, search_by_baseitem = False, cursor = None):
+        ''' rows whose name (or base item) contains searchname, cheapest first, only the exact match if there is one '''
+        keys = '''SELECT {}.name COLLATE NOCASE <> ? AS _exact, COALESCE(MAX(chaosValue), -1) AS _price, {}.name AS _name
+        FROM {}
+        left join ninja_data 
+        on ninja_data.league=? AND ninja_data.base_name={}.base_name
+        WHERE {}.{} COLLATE NOCASE LIKE "%"||?||"%" {} AND COALESCE(itemClass,0) <> 9
+        GROUP BY {}.name'''.format(tablename,tablename,tablename,tablename,tablename,'baseitem' if search_by_baseitem else 'name', 'AND drop_enabled' if league not in ('Standard','Hardcore') and tablename=='unique_items' else '', tablename)
+        page = self._exact_first(self._paged(keys,(searchname.lower(),league,searchname.lower()),('_exact','_price','_name'),cursor,limit))
         query = '''SELECT *, COALESCE(
                 ninja_data.icon, 
-                (SELECT icon FROM ninja_data WHERE name = {}.name AND league = "Standard" LIMIT 1)) AS fallback_icon
-        FROM {}
+                (SELECT icon FROM ninja_data AS fallback WHERE fallback.league = 'Standard' AND fallback.base_name = {0}.base_name LIMIT 1)) AS fallback_icon,
+                {0}.name AS _name
+        FROM {0}
         left join ninja_data 
-        on trim_variant({}.name)=ninja_data.name AND ninja_data.league=? 
-        COLLATE NOCASE WHERE {}.{} COLLATE NOCASE LIKE "%"||?||"%" {} AND COALESCE(itemClass,0) <> 9
-        GROUP BY {}.name 
-        ORDER BY MAX(chaosValue) 
-        LIMIT {}'''.format(tablename,tablename,tablename,tablename,'baseitem' if search_by_baseitem else 'name', 'AND drop_enabled' if league not in ('Standard','Hardcore') and tablename=='unique_items' else '', tablename, limit)
-        res=self.cursor.execute(query,(league,searchname.lower(),))
-        ret = res.fetchall()
-        if len(ret)>1:
-            for entry in ret:
-                if entry['name'].lower()==searchname.lower():
-                    return [entry]
-        return ret
+        on ninja_data.league=? AND ninja_data.base_name={0}.base_name
+        WHERE {0}.name IN ({{}}) AND COALESCE(itemClass,0) <> 9
+        GROUP BY {0}.name'''.format(tablename)
+        return self._fill(page,query,(league,))
         
     # split off into its own function thanks to alt quality.
-    def get_skill_data(self,tablename,searchname,league = None,limit = 9, search_by_baseitem = False):
+    @cached('searchname')
+    def get_skill_data(self,tablename,searchname,league = None,limit = 9, search_by_baseitem = False, cursor = None):
+        ''' a Page of skill groups ({'name':..., 'list':[rows]}) with a gem matching searchname, one page is limit groups '''
         price_data_to_keep = ['chaosValue','exaltedValue','divineValue']
-        query = f'''
-            WITH skill_groups AS (
-            SELECT skill_id_group
+        groups = f'''
+            SELECT skill_id_group, MIN({tablename}.name COLLATE NOCASE <> ?) AS _exact
             FROM {tablename}
             WHERE {tablename}.{'baseitem' if search_by_baseitem else 'name'} COLLATE NOCASE LIKE "%"||?||"%"
             {'AND drop_enabled' if league not in ('Standard','Hardcore') and tablename=='unique_items' else ''}
-            GROUP BY {tablename}.skill_id_group
-            LIMIT {limit}
-        )
+            GROUP BY {tablename}.skill_id_group'''
+        page = self._exact_first(self._paged(groups,(searchname.lower(),searchname.lower()),('_exact','skill_id_group'),cursor,limit))
+        if not page.rows:
+            return page
+        query = f'''
         SELECT *, qual_bonus as qual_bonus_normal,
         {','.join([i+'.'+k+' as '+i+'_'+k for i in ('p_n',) for k in price_data_to_keep])}
         FROM {tablename}
-        LEFT JOIN ninja_data p_n ON {tablename}.name = p_n.name AND p_n.league = ? COLLATE NOCASE
-        WHERE {tablename}.skill_id_group IN (SELECT skill_id_group FROM skill_groups)
+        LEFT JOIN ninja_data p_n ON p_n.league = ? AND p_n.base_name = {tablename}.base_name
+        WHERE {tablename}.skill_id_group IN ({','.join('?'*len(page.rows))})
         {'AND drop_enabled' if league not in ('Standard','Hardcore') and tablename=='unique_items' else ''}
         ORDER BY {tablename}.name COLLATE NOCASE LIKE '%' || ? || '%' DESC, {tablename}.skill_id_group == {tablename}.skill_id DESC
         '''
-        res=self.cursor.execute(query,(searchname.lower(),league,searchname.lower(),))
+        order = [r['skill_id_group'] for r in page.rows]
+        res=self.cursor.execute(query,[league]+order+[searchname.lower()])
         # print(query.replace('?',f"'{league}'"),searchname.lower())
         ret = res.fetchall()
         # now you need to group results by skill_id_group to batch trans/vaal gems
-        grouped = self._group_by_row(ret,'skill_id_group')
-        if len(grouped)>1:
-            for group in grouped:
-                for entry in group['list']:
-                    if entry['name'].lower()==searchname.lower():
-                        return [group]
-        return grouped
+        grouped = {group['list'][0]['skill_id_group']: group for group in self._group_by_row(ret,'skill_id_group')}
+        return page._replace(rows=[grouped[g] for g in order if g in grouped])
         
     def _group_by_row(self, data, row_name):
         # data is a list of sqlite Row objects (probably)
@@ -168,43 +578,127 @@ class PoeDB:
                 buckets[key]['list'].append(p)
         return list(buckets.values())
 
-    def unique_search_explicit(self,keywords,league,limit = 9):
-        query = '''SELECT * FROM unique_items left join ninja_data on unique_items.name=ninja_data.name AND ninja_data.league=? COLLATE NOCASE WHERE unique_items.expl COLLATE NOCASE LIKE "%"||?||"%" COLLATE NOCASE '''
-        for i in range(len(keywords)-1):
-            query+= 'AND unique_items.expl COLLATE NOCASE LIKE "%"||?||"%" COLLATE NOCASE '
-        if league not in ('Standard','Hardcore'):
-            query += 'AND drop_enabled'
-        query+=''' GROUP BY unique_items.name ORDER BY MAX(chaosValue) LIMIT {}'''.format(limit)
-        res=self.cursor.execute(query,(league,*keywords))
-        return res.fetchall()
-
-    def passive_search_description(self,keywords,limit = 9):
-        query = '''SELECT * FROM passive_skills WHERE passive_skills.desc COLLATE NOCASE LIKE "%"||?||"%" COLLATE NOCASE '''
-        for i in range(len(keywords)-1):
-            query+= 'AND passive_skills.desc COLLATE NOCASE LIKE "%"||?||"%" COLLATE NOCASE '
-        query+=''' LIMIT {}'''.format(limit)
-        res=self.cursor.execute(query,keywords)
-        return res.fetchall()
+    @cached('keywords')
+    def unique_search_explicit(self,keywords,league,limit = 9,cursor = None):
+        match = fts_query(keywords)
+        if not match:
+            return Page([], 0, None)
+        keys = '''WITH hits AS (SELECT rowid, rank FROM unique_items_fts WHERE unique_items_fts MATCH ?)
+        SELECT MIN(hits.rank) AS _rank, unique_items.name AS _name FROM hits
+        JOIN unique_items ON unique_items.rowid = hits.rowid
+        {}
+        GROUP BY unique_items.name'''.format('WHERE drop_enabled' if league not in ('Standard','Hardcore') else '')
+        page = self._paged(keys,(match,),('_rank','_name'),cursor,limit)
+        return self._fill(page,UNIQUE_PAGE_QUERY,(league,))
+
+    @cached('keywords')
+    def unique_search_mods(self,keywords,league,limit = 9,cursor = None):
+        '''
+        Uniques with a mod whose template contains every word and whose roll range reaches the range in keywords
+        (see mod_query), best possible roll first.
+        '''
+        words, low, high = mod_query(keywords)
+        if not words:
+            return Page([], 0, None)
+        where = ['template LIKE ?']*len(words)
+        params = ['%'+word+'%' for word in words]
+        if low is not None:
+            where.append('unique_mods.maximum >= ?')
+            params.append(low)
+        if high is not None:
+            where.append('unique_mods.minimum <= ?')
+            params.append(high)
+        # the (small) template table drives the lookup so unique_mods is only read through unique_mods_range,
+        # rolls are picked per item before the price join
+        keys = '''WITH hits AS (
+            SELECT unique_mods.name, unique_mods.minimum AS mod_minimum, MAX(unique_mods.maximum) AS mod_maximum
+            FROM mod_templates
+            CROSS JOIN unique_mods ON unique_mods.template_id = mod_templates.id
+            WHERE {}
+            GROUP BY unique_mods.name)
+        SELECT -COALESCE(hits.mod_maximum, -1e308) AS _roll, unique_items.name AS _name FROM hits
+        JOIN unique_items ON unique_items.name = hits.name
+        {}'''.format(' AND '.join(where), 'WHERE drop_enabled' if league not in ('Standard','Hardcore') else '')
+        page = self._paged(keys,params,('_roll','_name'),cursor,limit)
+        return self._fill(page,UNIQUE_PAGE_QUERY,(league,))
+
+    @cached('keywords')
+    def passive_search_description(self,keywords,limit = 9,cursor = None):
+        match = fts_query(keywords)
+        if not match:
+            return Page([], 0, None)
+        query = '''SELECT passive_skills.*, passive_skills_fts.rank AS _rank, passive_skills.rowid AS _rowid FROM passive_skills_fts
+        JOIN passive_skills ON passive_skills.rowid = passive_skills_fts.rowid
+        WHERE passive_skills_fts MATCH ?'''
+        return self._paged(query,(match,),('_rank','_rowid'),cursor,limit)
         
-    def get_currency(self,searchname,league,limit = 9,exact = False):
-        query = '''SELECT * FROM ninja_currency_data WHERE ninja_currency_data.league=? COLLATE NOCASE AND ninja_currency_data.name COLLATE NOCASE LIKE "%"||?||"%" LIMIT ?'''
+    @cached('searchname')
+    def get_currency(self,searchname,league,limit = 9,exact = False,cursor = None):
+        ''' currency rows whose name contains (or with exact, is) searchname, most valuable first '''
+        query = '''SELECT *, -COALESCE(chaosValue, 0) AS _price FROM ninja_currency_data WHERE ninja_currency_data.league=? COLLATE NOCASE AND ninja_currency_data.name COLLATE NOCASE LIKE "%"||?||"%"'''
         if exact:
-            query = '''SELECT * FROM ninja_currency_data WHERE ninja_currency_data.league=? COLLATE NOCASE AND ninja_currency_data.name COLLATE NOCASE = ? COLLATE NOCASE LIMIT ?'''
-        res=self.cursor.execute(query,(league,searchname.lower(),limit))
-        return res.fetchall()
+            query = '''SELECT *, -COALESCE(chaosValue, 0) AS _price FROM ninja_currency_data WHERE ninja_currency_data.league=? COLLATE NOCASE AND ninja_currency_data.name COLLATE NOCASE = ? COLLATE NOCASE'''
+        return self._paged(query,(league,searchname.lower()),('_price','id'),cursor,limit)
     
+    @cached('searchname')
+    def get_priced(self,searchname,league,limit = 9,cursor = None):
+        ''' poe.ninja item and currency rows matching searchname, tablename says which table a row is from (for price_history) '''
+        query = '''SELECT 'ninja_data' AS tablename, id, name, icon, chaosValue, divineValue, -COALESCE(chaosValue, 0) AS _price FROM ninja_data
+            WHERE league=? AND name COLLATE NOCASE LIKE "%"||?||"%"
+            UNION ALL
+            SELECT 'ninja_currency_data', id, name, icon, chaosValue, NULL, -COALESCE(chaosValue, 0) FROM ninja_currency_data
+            WHERE league=? AND name COLLATE NOCASE LIKE "%"||?||"%"'''
+        return self._paged(query,(league,searchname,league,searchname),('_price','tablename','id'),cursor,limit)
+
+    def exchange_rates(self):
+        ''' returns {league: {currency name: chaos value}} for every currency in RATE_ANCHORS '''
+        rates = {}
+        r = self.cursor.execute('''SELECT league, name, chaosValue FROM ninja_currency_data WHERE name IN ({})'''.format(','.join('?'*len(RATE_ANCHORS))),RATE_ANCHORS)
+        for league,name,value in r.fetchall():
+            rates.setdefault(league,{})[name] = value
+        return rates
+
+    def names(self):
+        '''
+        (table, name) for everything the bot looks up by name, used to build the fuzzy name index.
+        base types of uniques are listed as 'baseitem', see get_data(search_by_baseitem=True)
+        '''
+        return self.cursor.execute('''SELECT 'unique_items', name FROM unique_items
+                UNION SELECT 'baseitem', baseitem FROM unique_items WHERE baseitem IS NOT NULL
+                UNION SELECT 'skill_gems', name FROM skill_gems
+                UNION SELECT 'ninja_currency_data', name FROM ninja_currency_data
+                UNION SELECT 'passive_skills', name FROM passive_skills''').fetchall()
+
+    def name_values(self):
+        ''' (table, name, league, chaosValue) of every priced name in names(), orders autocomplete suggestions '''
+        return self.cursor.execute('''SELECT 'unique_items', unique_items.name, league, MAX(chaosValue) FROM unique_items
+                JOIN ninja_data ON ninja_data.base_name = unique_items.base_name WHERE chaosValue IS NOT NULL
+                GROUP BY unique_items.name, league
+                UNION ALL SELECT 'skill_gems', skill_gems.name, league, MAX(chaosValue) FROM skill_gems
+                JOIN ninja_data ON ninja_data.base_name = skill_gems.base_name WHERE chaosValue IS NOT NULL
+                GROUP BY skill_gems.name, league
+                UNION ALL SELECT 'ninja_currency_data', name, league, chaosValue FROM ninja_currency_data
+                WHERE chaosValue IS NOT NULL''').fetchall()
+
     def upcoming_event(self,warning_intervals=[5]):
         r=self.cursor.execute('''SELECT id || ' Starting in ' || CAST(strftime('%M',julianday(startAt)-julianday('now','-30 seconds')) AS INTEGER) || ' Minutes!' from event_times where strftime('%s',startAt) IN ({})'''.format(','.join(["strftime('%%s',datetime('now','+%i minutes'))"%x for x in warning_intervals])))
         return r.fetchall()
     
     def _scrape_events(self):
-        data = self.scraper.get('http://api.pathofexile.com/leagues?type=event&compact=1')
+        data = ratelimit.get('http://api.pathofexile.com/leagues?type=event&compact=1', session=self.scraper)
         try:
             js = data.json()
         except json.decoder.JSONDecodeError:
             js = {}
-        if len(js):
-            self.cursor.execute('''DELETE FROM event_times''')
+        if not len(js):
+            return
+        # rewriting the same events would count as a change and publish an otherwise unchanged snapshot
+        # (the casts skip the timestamp converter, these are stored as the api's text)
+        current = {tuple(row) for row in self.cursor.execute('''SELECT id, CAST(startAt AS TEXT), CAST(endAt AS TEXT), url FROM event_times''')}
+        fetched = {tuple(None if event.get(c) is None else str(event.get(c)) for c in ('id','startAt','endAt','url')) for event in js}
+        if current == fetched:
+            return
+        self.cursor.execute('''DELETE FROM event_times''')
         for event in js:
             self._insert_data(event,'event_times',ignore_nonexistant_cols=True)
             
@@ -214,7 +708,6 @@ class PoeDB:
         for name,url in pairs:
             thumb_url = scrape_poe_wiki.get_image_url(name,url,is_div_card=False)
             self.cursor.execute('UPDATE {} set thumbnail_url=? where name=?'.format(table),(thumb_url,name))
-            time.sleep(1)            
         
     def _insert_data(self, data, table, ignore_nonexistant_cols=False):
         '''
@@ -262,40 +755,332 @@ class PoeDB:
 
     def reset(self):
         self.cursor.execute('''DROP TABLE unique_items''')
+        self.cursor.execute('''DROP TABLE IF EXISTS unique_items_fts''')
+        self.cursor.execute('''DROP TABLE IF EXISTS unique_mods''')
+        self.cursor.execute('''DROP TABLE IF EXISTS mod_templates''')
         self.cursor.execute('''DROP TABLE skill_gems''')
         self.cursor.execute('''DROP TABLE ninja_data''')
         self.cursor.execute('''DROP TABLE ninja_currency_data''')
+        self.cursor.execute('''DROP TABLE IF EXISTS sync_state''') # forces a full wiki scrape
         self._create_tables()
         self.conn.commit()
 
+class AsyncPoeDB:
+    '''
+    Async facade over PoeDB so a slow query never blocks the event loop.
+
+    Queries run on a dedicated thread pool where every thread has its own read-only PoeDB, which picks up newly
+    published snapshots before each call. Any public PoeDB method can be awaited, e.g. await adb.get_data(...)
+    '''
+    def __init__(self,dbfile="poedb.sqlite",workers=2):
+        self.db = dbfile
+        self.cache = ResultCache()
+        self._rates = {}
+        self._rates_id = None
+        self._names = nameindex.NameIndex(())
+        self._prefixes = nameindex.PrefixIndex(())
+        self._names_id = None
+        self._names_lock = asyncio.Lock()
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='poedb')
+
+    def _thread_db(self):
+        poedb = getattr(self._local, 'poedb', None)
+        if poedb is None:
+            poedb = self._local.poedb = PoeDB(ro=True, dbfile=self.db, cache=self.cache)
+        else:
+            poedb.check_generation()
+        return poedb
+
+    def _call(self, name, *args, **kwargs):
+        return getattr(self._thread_db(), name)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(PoeDB, name, None)):
+            raise AttributeError(name)
+        async def method(*args, **kwargs):
+            return await asyncio.get_running_loop().run_in_executor(self._pool, functools.partial(self._call, name, *args, **kwargs))
+        return method
+
+    def snapshot_id(self):
+        ''' changes whenever db.py publishes new data, for keying anything derived from it '''
+        return '{}-{}'.format(*file_id(self.db))
+
+    async def league_rates(self, league):
+        '''
+        Chaos value of each RATE_ANCHORS currency in league.
+
+        The table for every league is loaded once per published snapshot and then served from memory.
+        '''
+        current = file_id(self.db)
+        if current != self._rates_id:
+            self._rates = await self.exchange_rates()
+            self._rates_id = current
+        return self._rates.get(league, {})
+
+    async def suggest(self, name, tables=None, limit=5):
+        '''
+        [(table, name), ...] of the names closest to name (typos, missing words), best first, only from tables if given.
+
+        The fuzzy index is built in memory from every name once per published snapshot, lookups then take well
+        under a millisecond and run on the event loop.
+        '''
+        await self._load_names()
+        return [(table, n) for score, table, n in self._names.search(name, kinds=tables, limit=limit)]
+
+    async def complete(self, prefix, table, league=None, limit=25):
+        '''
+        [(name, chaos value or None), ...] of names in table with a word starting with prefix, most valuable in
+        league first. Served from memory like suggest, for slash command autocomplete.
+        '''
+        await self._load_names()
+        return self._prefixes.complete(prefix, table, league, limit)
+
+    async def _load_names(self):
+        '''
+        (re)builds the in-memory name indexes when a new snapshot was published.
+        callers arriving during a rebuild wait for it instead of starting their own.
+        '''
+        async with self._names_lock:
+            current = file_id(self.db)
+            if current == self._names_id:
+                return
+            names = [tuple(r) for r in await self.names()]
+            try:
+                values = {(table, name, league): value for table, name, league, value in await self.name_values()}
+            except sqlite3.OperationalError:
+                # published before base_name existed, completions just aren't ordered by price until the next ingest
+                values = {}
+            loop = asyncio.get_running_loop()
+            self._names = await loop.run_in_executor(self._pool, nameindex.NameIndex, names, normalize_name)
+            self._prefixes = await loop.run_in_executor(self._pool, nameindex.PrefixIndex, names, values, normalize_name)
+            self._names_id = current
+
+    def close(self):
+        self._pool.shutdown()
+
+class AsyncSQLite:
+    '''
+    Async access to the bot's own read/write databases (announcements, settings, reminders).
+
+    Reads run on a thread pool with a read-only connection per thread. Writes are queued on a single writer
+    thread, so they are applied and committed in order. The database is switched to WAL so readers never wait on the writer.
+    '''
+    def __init__(self,dbfile,readers=2):
+        self.db = dbfile
+        self._local = threading.local()
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='sqlite-read')
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-write')
+        self._write_conn = None
+        conn = sqlite3.connect(self.db)
+        conn.execute('''PRAGMA journal_mode=WAL''')
+        conn.close()
+
+    def _read(self, sql, params, one):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect('file:%s?mode=ro'%self.db, uri=True)
+        r = conn.execute(sql, params)
+        return r.fetchone() if one else r.fetchall()
+
+    def _write(self, sql, params, many, result='rowcount'):
+        if self._write_conn is None:
+            self._write_conn = sqlite3.connect(self.db)
+        with self._write_conn:
+            if many:
+                r = self._write_conn.executemany(sql, params)
+            else:
+                r = self._write_conn.execute(sql, params)
+            return getattr(r, result)
+
+    def _write_script(self, script):
+        if self._write_conn is None:
+            self._write_conn = sqlite3.connect(self.db)
+        try:
+            self._write_conn.executescript(script)
+        except sqlite3.Error:
+            # a failed script leaves its BEGIN open, don't let the next write commit half of it
+            self._write_conn.rollback()
+            raise
+
+    async def fetchall(self, sql, params=()):
+        return await asyncio.get_running_loop().run_in_executor(self._readers, self._read, sql, params, False)
+
+    async def fetchone(self, sql, params=()):
+        return await asyncio.get_running_loop().run_in_executor(self._readers, self._read, sql, params, True)
+
+    async def execute(self, sql, params=()):
+        ''' run a write statement and commit it, returns the number of rows changed '''
+        return await asyncio.get_running_loop().run_in_executor(self._writer, self._write, sql, params, False)
+
+    async def executemany(self, sql, seq_of_params):
+        return await asyncio.get_running_loop().run_in_executor(self._writer, self._write, sql, list(seq_of_params), True)
+
+    async def insert(self, sql, params=()):
+        ''' run an INSERT and commit it, returns the rowid of the new row '''
+        return await asyncio.get_running_loop().run_in_executor(self._writer, self._write, sql, params, False, 'lastrowid')
+
+    async def executescript(self, script):
+        ''' run several statements, wrap them in BEGIN; ... COMMIT; to apply them all or none (e.g. a migration) '''
+        return await asyncio.get_running_loop().run_in_executor(self._writer, self._write_script, script)
+
+    def close(self):
+        self._readers.shutdown()
+        self._writer.shutdown()
+
+class ChannelSettings:
+    '''
+    In-memory copy of the per-channel/server configuration tables in the bot's AsyncSQLite database.
+
+    load() reads everything once at startup, setters write through to sqlite before updating memory,
+    so lookups never touch the database.
+    '''
+    def __init__(self, sql, default_league='tmpStandard', default_timezone='UTC'):
+        self.sql = sql
+        self.default_league = default_league
+        self.default_timezone = default_timezone
+        self._leagues = {}
+        self._filters = {}
+        self._timezones = {}
+
+    async def load(self):
+        self._leagues = dict(await self.sql.fetchall('SELECT channel, league FROM pricecheck'))
+        self._filters = {}
+        for channel, type, regexp in await self.sql.fetchall('SELECT channel, type, regexp FROM regexp_filters'):
+            try:
+                self._filters[(channel, type)] = (regexp, re.compile(regexp, flags=re.I|re.M))
+            except re.error as e:
+                print('ignoring invalid %s filter for %s (%r): %s'%(type, channel, regexp, e))
+        self._timezones = dict(await self.sql.fetchall('SELECT server, timezone FROM timezones'))
+
+    def league(self, channel):
+        return self._leagues.get(channel, self.default_league)
+
+    async def set_league(self, channel, league):
+        await self.sql.execute('REPLACE INTO pricecheck (channel,league) VALUES (?,?)',(channel,league))
+        self._leagues[channel] = league
+
+    def regexp_filter(self, channel, type):
+        ''' returns (regexp text, compiled pattern) or None if the channel has no filter '''
+        return self._filters.get((channel, type))
+
+    async def set_regexp_filter(self, channel, type, regexp):
+        ''' raises re.error if regexp does not compile, nothing is stored in that case '''
+        compiled = re.compile(regexp, flags=re.I|re.M)
+        await self.sql.execute('REPLACE INTO regexp_filters (channel,type,regexp) VALUES (?,?,?)',(channel,type,regexp))
+        self._filters[(channel, type)] = (regexp, compiled)
+
+    def timezone(self, server):
+        return self._timezones.get(server) or self.default_timezone
+
+    async def set_timezone(self, server, tz):
+        await self.sql.execute('REPLACE INTO timezones(server,timezone) VALUES(?,?)',(server,tz))
+        self._timezones[server] = tz
+
+@contextlib.contextmanager
+def snapshot(dbfile="poedb.sqlite"):
+    '''
+    Build a new version of the database next to dbfile and publish it atomically.
+
+    Yields a writable PoeDB seeded with a copy of dbfile. When the block exits cleanly the copy is
+    renamed over dbfile, so readers only ever see a complete dataset (see PoeDB.check_generation).
+    Concurrent builders (the hourly -pc run during the full refresh) wait on a lock instead of racing.
+    If nothing was written and the schema is the same (no new tables/columns from _create_tables) the copy is
+    dropped, so readers keep their connections and caches.
+    '''
+    building = dbfile + '.building'
+    with open(dbfile + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(building):
+            os.remove(building)
+        schema = None
+        if os.path.exists(dbfile):
+            src = sqlite3.connect('file:%s?mode=ro'%dbfile, uri=True)
+            dst = sqlite3.connect(building)
+            src.backup(dst)
+            schema = dst.execute('''PRAGMA schema_version''').fetchone()[0]
+            src.close()
+            dst.close()
+        a = PoeDB(dbfile=building)
+        try:
+            yield a
+        except BaseException:
+            a.close()
+            os.remove(building)
+            raise
+        changes = a.conn.total_changes
+        migrated = a.conn.execute('''PRAGMA schema_version''').fetchone()[0] != schema
+        a.close()
+        if not changes and not migrated:
+            print('no changes, keeping', dbfile)
+            os.remove(building)
+            return
+        os.replace(building, dbfile)
+
 if __name__=='__main__':
     import sys
-    import datetime
-    
-    a = PoeDB()
-    a._scrape_events()
-    print(datetime.datetime.now())
-    if len(sys.argv)>1 and sys.argv[1]=='-r':
-        a.reset()
-    if len(sys.argv)>1 and sys.argv[1]=='-pc':
-        pass #pricecheck only
-    else:
-        #scrape uniques
-        a.add_items_async(scrape_poe_wiki.format_affixes(scrape_poe_wiki.scrape_unique_items()))
-        #scrape skill gems
-        a.add_items_async(scrape_poe_wiki.scrape_skill_gems(),'skill_gems')
-        #scrape skill quality -- no longer used
-        # a.add_items_async(scrape_poe_wiki.scrape_skill_quality(),'skill_quality')
-        #scrape passive skills
-        a.add_items_async(scrape_poe_wiki.scrape_passive_skills(),'passive_skills')
-        #scape events (RIP)
-        a._scrape_events()
-    # get poe.ninja data (mainly for price)
-    for league in VALID_PC_LEAGUES:
-        data = scrape_poe_wiki.get_ninja_prices(league)
-        if data:
-            a.add_items_async(data,'ninja_data')
-        data = scrape_poe_wiki.get_ninja_rates(league)
-        if data:
-            a.add_items_async(data,'ninja_currency_data')
-    a.close()
+
+    # unchanged poe.ninja/wiki responses are skipped, -replay reruns the ingest from the cached responses only
+    http_cache = scrape_poe_wiki.HTTP_CACHE
+    http_cache.autocommit = False
+    http_cache.replay = '-replay' in sys.argv
+    try:
+        with snapshot() as a:
+            a._scrape_events()
+            print(datetime.datetime.now())
+            if len(sys.argv)>1 and sys.argv[1]=='-r':
+                a.reset()
+            if len(sys.argv)>1 and sys.argv[1]=='-pc':
+                pass #pricecheck only
+            else:
+                #scrape uniques, skill gems and passive skills in parallel
+                #only pages changed since the last sync unless -full is given or the last sync is too old
+                started = datetime.datetime.now(datetime.timezone.utc)
+                since = a.get_sync_state('wiki_last_sync')
+                pages = None
+                if '-full' not in sys.argv and since and started - datetime.datetime.strptime(since, scrape_poe_wiki.WIKI_TIMESTAMP_FORMAT).replace(tzinfo=datetime.timezone.utc) < scrape_poe_wiki.RECENT_CHANGES_MAX_AGE:
+                    pages = scrape_poe_wiki.changed_pages(since)
+                    if pages is None:
+                        print('could not fetch wiki changes, doing a full scrape')
+                    else:
+                        print('{} wiki pages changed since {}'.format(len(pages), since))
+                uniques, gems, passives, complete = scrape_poe_wiki.scrape_wiki(pages)
+                if pages is not None and complete:
+                    # drops rows for deleted/moved pages, and pages that no longer have cargo rows
+                    a.delete_pages(pages)
+                a.add_items_async(scrape_poe_wiki.format_affixes(uniques))
+                a.add_items_async(gems,'skill_gems')
+                #scrape skill quality -- no longer used
+                # a.add_items_async(scrape_poe_wiki.scrape_skill_quality(),'skill_quality')
+                a.add_items_async(passives,'passive_skills')
+                if complete and not http_cache.replay:
+                    a.set_sync_state('wiki_last_sync', started.strftime(scrape_poe_wiki.WIKI_TIMESTAMP_FORMAT))
+                #scape events (RIP)
+                a._scrape_events()
+            # get poe.ninja data (mainly for price), every league and type in parallel, written as each one arrives
+            # only rows whose values moved are written, the rest of a fetched type just gets a new timestamp
+            deltas = {}
+            applied = {}
+            for table,league,category,data,changed in scrape_poe_wiki.fetch_ninja(VALID_PC_LEAGUES):
+                if changed:
+                    counts = a.apply_changes(data,table,league,category)
+                    deltas[league] = [x+y for x,y in zip(deltas.get(league,(0,0,0)),counts)]
+                    applied.setdefault((table,league),set()).add(category)
+                a.mark_fetched(table,league,category)
+            # rows without a category predate that column, apply_changes only deletes within a category
+            types = {'ninja_data': scrape_poe_wiki.NINJA_ITEM_TYPES, 'ninja_currency_data': scrape_poe_wiki.NINJA_CURRENCY_TYPES}
+            for (table,league),categories in applied.items():
+                if categories >= set(types[table]):
+                    deltas[league][2] += a.drop_uncategorized(table,league)
+            for league,(inserted,updated,deleted) in deltas.items():
+                print('{}: {} inserted, {} updated, {} deleted'.format(league,inserted,updated,deleted))
+            # downsample price history once a day, it scans the whole table
+            last_compacted = float(a.get_sync_state('history_compacted') or 0)
+            if time.time() - last_compacted > 60*60*24:
+                print('price history: {} points compacted'.format(a.compact_history()))
+                a.set_sync_state('history_compacted', str(time.time()))
+    except BaseException:
+        # nothing was published, so the next run has to see these responses as changed again
+        http_cache.discard()
+        raise
+    http_cache.commit()
@@ -0,0 +1,129 @@
+'''
+Delivery of announcements (forum posts, deals, events) to every subscribed channel.
+
+Channels with something to send go through one queue worked by a pool of tasks, so hundreds of channels are sent
+to concurrently instead of one after another. Each channel has its own backlog that only one worker drains at a time,
+so its messages arrive in order (even from announcements running at the same time) and its route bucket only ever
+sees one request. Every send takes a token from a shared bucket that stays under Discord's global rate limit.
+discord.py still waits out any 429 that gets through.
+'''
+import asyncio
+import time
+from collections import Counter, deque
+import ratelimit
+
+# messages per second for the whole bot, discord allows 50 requests per second
+GLOBAL_RATE = 40
+WORKERS = 20
+
+class Batch:
+    ''' the deliveries of one announcement, done is set once every message was sent or failed '''
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.started = time.monotonic()
+        self.latencies = []
+        self.failures = Counter()
+        self.done = asyncio.Event()
+        if not total:
+            self.done.set()
+
+    def finish(self, error=None):
+        if error is None:
+            self.latencies.append(time.monotonic() - self.started)
+        else:
+            self.failures[type(error).__name__] += 1
+        if len(self.latencies) + sum(self.failures.values()) == self.total:
+            self.done.set()
+
+    def summary(self):
+        text = 'announced {}: {}/{} messages sent in {:.1f}s'.format(self.name, len(self.latencies), self.total, time.monotonic() - self.started)
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            text += ', latency p50 {:.2f}s p95 {:.2f}s max {:.2f}s'.format(
+                latencies[len(latencies)//2], latencies[int(len(latencies)*.95)], latencies[-1])
+        if self.failures:
+            text += ', failed: ' + ', '.join('{} {}'.format(count, error) for error, count in self.failures.most_common())
+        return text
+
+class AnnouncementQueue:
+    def __init__(self, send, rate=GLOBAL_RATE, workers=WORKERS):
+        '''
+        send is the coroutine function doing one delivery, called as send(channel, **message).
+        '''
+        self.send = send
+        self.bucket = ratelimit.TokenBucket(rate, rate, burst=rate)
+        self.workers = workers
+        self.stats = Counter()
+        self._queue = None
+        self._tasks = []
+        # channel: deque of (batch, messages) not sent yet, a channel is in the queue once while it has any
+        self._backlogs = {}
+
+    def _start(self):
+        # the queue and workers belong to the running loop, so they are only made once something is announced
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [asyncio.create_task(self._work()) for i in range(self.workers)]
+
+    async def announce(self, name, deliveries):
+        '''
+        deliveries is [(channel, [message kwargs, ...]), ...], waits until all of them were sent or failed.
+        returns the Batch with the latency of every sent message and the failures by exception type.
+        '''
+        deliveries = [(channel, messages) for channel, messages in deliveries if messages]
+        batch = Batch(name, sum(len(messages) for channel, messages in deliveries))
+        self._start()
+        for channel, messages in deliveries:
+            if channel in self._backlogs:
+                # a worker has (or will have) this channel, it picks these up after what it is sending
+                self._backlogs[channel].append((batch, messages))
+            else:
+                self._backlogs[channel] = deque([(batch, messages)])
+                self._queue.put_nowait(channel)
+        await batch.done.wait()
+        if batch.total:
+            print(batch.summary())
+        return batch
+
+    async def _work(self):
+        while True:
+            channel = await self._queue.get()
+            backlog = self._backlogs[channel]
+            batch, unsent = None, 0
+            try:
+                while backlog:
+                    batch, messages = backlog.popleft()
+                    unsent = len(messages)
+                    for message in messages:
+                        await self.bucket.acquire()
+                        try:
+                            await self.send(channel, **message)
+                        except Exception as e:
+                            # channel missing, bot blocked or kicked, ...
+                            if getattr(e, 'status', None) == 429:
+                                self.bucket.throttled()
+                            self.stats['failed'] += 1
+                            batch.finish(e)
+                        else:
+                            self.bucket.success()
+                            self.stats['sent'] += 1
+                            batch.finish()
+                        unsent -= 1
+            except BaseException as e:
+                # cancelled (see close), nothing else would send the rest or end the batches waiting on it
+                failed = [(batch, unsent)] if batch else []
+                failed += [(batch, len(messages)) for batch, messages in backlog]
+                for batch, count in failed:
+                    self.stats['failed'] += count
+                    for i in range(count):
+                        batch.finish(e)
+                raise
+            finally:
+                # the next announce for this channel queues it again
+                del self._backlogs[channel]
+                self._queue.task_done()
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
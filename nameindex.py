@@ -0,0 +1,95 @@
+'''
+Name lookups held in memory: typo tolerant matching (NameIndex), so "headhuntr" still finds Headhunter, and
+completion of partially typed names for slash command autocomplete (PrefixIndex).
+
+For NameIndex names are split into character trigrams and an inverted index (one per kind of name) maps every trigram to the
+names containing it.
+A query only looks at names sharing at least one trigram with it and ranks them by the Dice coefficient of the
+two trigram sets (1.0 for the same name, 0 for nothing in common).
+'''
+from bisect import bisect_left
+from collections import Counter
+import heapq
+
+def trigrams(text):
+    ''' set of 3 character substrings, padded so the start and end of the text weigh more '''
+    text = '  {} '.format(text)
+    return {text[i:i+3] for i in range(len(text)-2)}
+
+class NameIndex:
+    def __init__(self, names, normalize=str.casefold):
+        '''
+        names is an iterable of (kind, name), kind is whatever the caller wants to filter on (e.g. the table).
+        normalize is applied to names and queries before splitting them.
+        '''
+        self.normalize = normalize
+        self.names = []
+        self.sizes = []
+        postings = {}
+        for kind, name in dict.fromkeys(names):
+            key = normalize(name)
+            if not key:
+                continue
+            grams = trigrams(key)
+            kind_postings = postings.setdefault(kind, {})
+            for gram in grams:
+                kind_postings.setdefault(gram, []).append(len(self.names))
+            self.names.append((kind, name))
+            self.sizes.append(len(grams))
+        self.postings = {kind: {gram: tuple(ids) for gram, ids in p.items()} for kind, p in postings.items()}
+
+    def __len__(self):
+        return len(self.names)
+
+    def search(self, query, kinds=None, limit=5, min_score=0.4):
+        ''' [(score, kind, name), ...] best first, only kinds in kinds if given '''
+        grams = trigrams(self.normalize(query or ''))
+        shared = Counter()
+        for kind in (self.postings if kinds is None else kinds):
+            postings = self.postings.get(kind, {})
+            for gram in grams:
+                shared.update(postings.get(gram, ()))
+        hits = []
+        for id, count in shared.items():
+            score = 2*count/(len(grams) + self.sizes[id])
+            if score >= min_score:
+                hits.append((score, *self.names[id]))
+        # on a tie the shorter name wins, so "headhuntr" is Headhunter rather than Headhunter (Replica)
+        return heapq.nlargest(limit, hits, key=lambda hit: (hit[0], -len(hit[2])))
+
+class PrefixIndex:
+    '''
+    Names by the start of any of their words, so "heart" and "kaom" both complete to Kaom's Heart.
+
+    Every word suffix of a normalized name ("kaoms heart", "heart") is kept in one sorted list per kind of name,
+    a completion is a bisect to the prefix followed by picking the most valuable names in that range.
+    '''
+    def __init__(self, names, values=None, normalize=str.casefold):
+        '''
+        names is an iterable of (kind, name), values is {(kind, name, group): value} used to order completions
+        (e.g. price per league), names without a value come last.
+        '''
+        self.normalize = normalize
+        self.values = values or {}
+        entries = {}
+        for kind, name in dict.fromkeys(names):
+            words = (normalize(name) or '').split()
+            for i in range(len(words)):
+                entries.setdefault(kind, []).append((' '.join(words[i:]), name))
+        self.keys = {}
+        self.names = {}
+        for kind, pairs in entries.items():
+            pairs.sort()
+            self.keys[kind] = [key for key, name in pairs]
+            self.names[kind] = [name for key, name in pairs]
+
+    def complete(self, prefix, kind, group=None, limit=25):
+        ''' [(name, value or None), ...] of names with a word starting with prefix, highest value first '''
+        keys = self.keys.get(kind, [])
+        prefix = self.normalize(prefix or '') or ''
+        start = bisect_left(keys, prefix)
+        end = bisect_left(keys, prefix + '\uffff', start)
+        values = self.values
+        best = heapq.nlargest(limit, dict.fromkeys(self.names[kind][start:end]) if keys else (),
+                              key=lambda name: (values.get((kind, name, group), -1), -len(name)))
+        return [(name, values.get((kind, name, group))) for name in best]
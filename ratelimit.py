@@ -0,0 +1,165 @@
+'''
+Per-host request pacing and retries shared by every outbound scraper (wiki, poe.ninja, pathofexile.com, poelab, ...).
+
+Each host gets one adaptive token bucket for the whole process, so the scrapers and the bot's background tasks
+never add up to more than that host's budget. The rate creeps up towards max_rate while the host answers normally
+and is halved on a 429/5xx or connection error. A Retry-After header pauses the host for that long.
+'''
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+import aiohttp
+
+# host: (starting requests per second, max requests per second)
+HOST_LIMITS = {
+    'www.poewiki.net': (1.0, 4.0),
+    'poe.ninja': (2.0, 6.0),
+    'www.pathofexile.com': (0.2, 1.0),
+    'api.pathofexile.com': (0.2, 1.0),
+    'www.poelab.com': (0.5, 2.0),
+    'hk4e-api-os.mihoyo.com': (1.0, 2.0),
+}
+DEFAULT_LIMIT = (1.0, 2.0)
+MIN_RATE = 0.05
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+class TokenBucket:
+    '''
+    Thread safe token bucket, acquire()/wait() block until the next request may start.
+
+    Waiting callers re-check the bucket when they wake up instead of reserving a slot, so a queue of parallel
+    requests speeds up as soon as the rate does.
+    '''
+    def __init__(self, rate, max_rate, burst=1):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        ''' takes a token and returns 0, or returns how long until the next one is due '''
+        with self._lock:
+            now = time.monotonic()
+            if now > self.updated:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated)*self.rate)
+                self.updated = now
+            if now >= self.updated and self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return max(self.updated - now, (1 - self.tokens)/self.rate)
+
+    def wait(self):
+        while delay := self._take():
+            time.sleep(delay)
+
+    async def acquire(self):
+        while delay := self._take():
+            await asyncio.sleep(delay)
+
+    def success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate/20)
+
+    def throttled(self, retry_after=None):
+        ''' the host pushed back: halve the rate, and pause it for retry_after seconds if given '''
+        with self._lock:
+            self.rate = max(MIN_RATE, self.rate/2)
+            if retry_after:
+                self.updated = max(self.updated, time.monotonic() + retry_after)
+                self.tokens = min(self.tokens, 0)
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def bucket(url):
+    ''' the shared bucket for the host of url (a bare host name works too) '''
+    host = urlsplit(url).hostname or url
+    with _buckets_lock:
+        if host not in _buckets:
+            _buckets[host] = TokenBucket(*HOST_LIMITS.get(host, DEFAULT_LIMIT))
+        return _buckets[host]
+
+def configure(url, rate, max_rate=None):
+    ''' override the limits of a host, e.g. from a script's own settings '''
+    HOST_LIMITS[urlsplit(url).hostname or url] = (rate, max_rate or rate)
+    with _buckets_lock:
+        _buckets.pop(urlsplit(url).hostname or url, None)
+
+def backoff(attempt, base=2, cap=60):
+    ''' exponential backoff with full jitter '''
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+def retry_after(headers):
+    ''' seconds from a Retry-After header (delay or http date), None if missing or unreadable '''
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def get(url, session=requests, attempts=3, **kwargs):
+    '''
+    session.get(url, **kwargs) paced by the host's bucket, retried with backoff on connection errors, 429 and 5xx.
+
+    session can be requests, a requests.Session or a cloudscraper scraper. Returns the last response once
+    attempts run out, connection errors are raised from the last attempt.
+    '''
+    limiter = bucket(url)
+    for attempt in range(attempts):
+        limiter.wait()
+        try:
+            r = session.get(url, **kwargs)
+        except requests.RequestException:
+            limiter.throttled()
+            if attempt == attempts-1:
+                raise
+            time.sleep(backoff(attempt))
+            continue
+        if r.status_code not in RETRY_STATUS:
+            limiter.success()
+            return r
+        delay = retry_after(r.headers)
+        limiter.throttled(delay)
+        if attempt == attempts-1:
+            return r
+        if delay is None:
+            time.sleep(backoff(attempt))
+
+async def aget(session, url, attempts=3, **kwargs):
+    '''
+    aiohttp version of get(), returns (status, headers, body bytes) of the last response.
+    '''
+    limiter = bucket(url)
+    for attempt in range(attempts):
+        await limiter.acquire()
+        try:
+            async with session.get(url, **kwargs) as r:
+                status, headers, body = r.status, r.headers, await r.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            limiter.throttled()
+            if attempt == attempts-1:
+                raise
+            await asyncio.sleep(backoff(attempt))
+            continue
+        if status not in RETRY_STATUS:
+            limiter.success()
+            return status, headers, body
+        delay = retry_after(headers)
+        limiter.throttled(delay)
+        if attempt == attempts-1:
+            break
+        if delay is None:
+            await asyncio.sleep(backoff(attempt))
+    return status, headers, body
@@ -0,0 +1,82 @@
+'''
+Deadline scheduler for expiring bot state (auto deleted failure messages).
+
+Pending callbacks are kept in a min-heap ordered by deadline, and one task sleeps until the earliest one is due,
+so each callback fires at its own deadline and scheduling costs O(log n) however much is pending.
+A cancelled entry drops its callback straight away and is removed from the heap when it reaches the top
+(or when cancelled entries make up most of the heap).
+'''
+import asyncio
+import heapq
+import itertools
+import time
+
+class Scheduler:
+    def __init__(self):
+        self._heap = []
+        # key: [deadline, sequence, key, callback], the same lists as in the heap
+        self._entries = {}
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._running = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def schedule(self, key, delay, callback):
+        '''
+        await callback() delay seconds from now, replacing anything already scheduled for key.
+        must be called from the event loop.
+        '''
+        self.cancel(key)
+        entry = [time.monotonic() + delay, next(self._sequence), key, callback]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        elif self._heap[0] is entry:
+            # sooner than what the task is sleeping for
+            self._wakeup.set()
+
+    def cancel(self, key):
+        ''' unschedules key, returns its callback (so the caller can run it early) or None if nothing was pending '''
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        callback = entry[3]
+        entry[3] = None
+        if len(self._heap) > 64 and len(self._heap) > 2*len(self._entries):
+            self._heap = [entry for entry in self._heap if entry[3] is not None]
+            heapq.heapify(self._heap)
+        return callback
+
+    async def _run(self):
+        while self._heap:
+            delay = self._heap[0][0] - time.monotonic()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            deadline, _, key, callback = heapq.heappop(self._heap)
+            if callback is None:
+                continue
+            del self._entries[key]
+            # run as its own task so a slow callback does not hold up the deadlines after it
+            task = asyncio.create_task(self._call(key, callback))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+        self._task = None
+
+    async def _call(self, key, callback):
+        try:
+            await callback()
+        except Exception as e:
+            print('error running scheduled %r: %r'%(key, e))
@@ -5,7 +5,10 @@ https://github.com/aRTy42/scrape_poe_info/blob/master/scrape_poe_uniques.py
 it still relies on and fetches the file https://raw.githubusercontent.com/aRTy42/scrape_poe_info/master/UniqueStyleVariants.json
 """
 from difflib import SequenceMatcher
-import requests, re, datetime, time, json, os
+import requests, re, datetime, time, json, os, hashlib
+import asyncio, aiohttp
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import ratelimit
 import urllib.parse as urlparse
 import html
 import time
@@ -18,6 +21,19 @@ dname = os.path.dirname(abspath)
 os.chdir(dname)
 ##SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
 WIKI_BASE = 'https://www.poewiki.net/w/'
+# cargoquery fetch engine settings, see CargoFetcher (request rate is in ratelimit.HOST_LIMITS)
+WIKI_CONCURRENCY = 4
+CARGO_QUERY_LIMIT = 500
+# titles per cargoquery when only fetching changed pages
+CARGO_PAGES_PER_QUERY = 50
+# recentchanges only goes back so far on the wiki, older syncs need a full scrape
+RECENT_CHANGES_MAX_AGE = datetime.timedelta(days=30)
+WIKI_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+HTTP_CACHE_DIR = 'http_cache'
+# cargo tables the bot scrapes, changed_pages watches every namespace their pages are in
+WIKI_CARGO_TABLES = ('items', 'skill_gems', 'passive_skills')
+# wiki thumbnails practically never change once a page has one
+IMAGE_URL_MAX_AGE = 60*60*24*30
 
 regex_wikilinks = re.compile(r'\[\[([^\]\|]*)\]\]|\[\[[^\]\|]*\|([^\]\|]*)\]\]')
 """
@@ -60,6 +76,46 @@ def remove_hidden_mods(mod_list):
         
         return new_mod_list                     
 
+regex_mod_value = re.compile(r'\((-?\d+(?:\.\d+)?)\s*(?:-|–|to)\s*(-?\d+(?:\.\d+)?)\)|(?<![\w.])(-?\d+(?:\.\d+)?)')
+"""
+matches a rolled range "(10-20)" (capture groups 1 and 2) or a fixed value "15" (capture group 3) in a mod line.
+a minus sign belongs to the value, a plus sign stays in the template, so "+(10-20)%" becomes "+#%".
+"""
+
+def parse_mod(mod):
+        """
+        Splits a mod line into a template and its roll range, e.g. "+(60-80) to maximum Life" -> ("+# to maximum Life", 60, 80).
+        Mods with several values ("Adds (5-10) to (15-20) Physical Damage") use the average of each end of the ranges,
+        mods without values ("Cannot be Frozen") have None for both. Returns None for empty lines.
+        """
+        mod = ' '.join(re.sub(r'<[^>]*>', ' ', mod.replace('**', '')).split())
+        if not mod:
+                return None
+        lows, highs = [], []
+        def value(match):
+                low, high, fixed = match.groups()
+                lows.append(float(fixed if fixed is not None else low))
+                highs.append(float(fixed if fixed is not None else high))
+                return '#'
+        template = regex_mod_value.sub(value, mod)
+        if not lows:
+                return template, None, None
+        return template, sum(lows)/len(lows), sum(highs)/len(highs)
+
+def item_mods(item):
+        """
+        (implicit, template, minimum, maximum) for each mod line of a formatted item (see format_affixes).
+        """
+        mods = []
+        for implicit, column, separator in ((1, 'impl', ' | '), (0, 'expl', '\n')):
+                if not item.get(column) or '<th' in item[column]:
+                        continue # tabula style tables hold no rolls
+                for line in item[column].split(separator):
+                        parsed = parse_mod(line)
+                        if parsed:
+                                mods.append((implicit,) + parsed)
+        return mods
+
 def format_affixes(item_list):
         new_data = []
         
@@ -114,12 +170,273 @@ def format_affixes(item_list):
                                 item['expl'] = '\n'.join(expl_mod_list)
                         else:
                                 item['expl'] = None
+                item['mods'] = item_mods(item)   # indexed in unique_mods for -um range searches
                 new_data.append(item)
                 
         print('\nManually prepared style variants included for these items:\n' + '\n'.join(style_variant_included) + '\n(Make sure they are still correct)\n')
         
         return new_data
 
+class HTTPCache:
+    '''
+    On-disk cache of response bodies keyed by url (+ params), revalidated with If-None-Match/If-Modified-Since.
+
+    get() tells the caller whether the body changed since the last fetch (304, or the same content hash),
+    so unchanged poe.ninja/wiki data can skip parsing and db writes.
+    New entries are only pending until commit() when autocommit is off, that way a failed ingest does not
+    leave the cache claiming data is unchanged that never made it into the db.
+    With replay set nothing goes to the network, every lookup is answered from disk and reported as changed,
+    which reruns an ingest offline from the last fetched responses.
+    '''
+    def __init__(self, directory=HTTP_CACHE_DIR, replay=False, autocommit=True, session=None):
+        self.directory = directory
+        self.replay = replay
+        self.autocommit = autocommit
+        self.session = session or requests.Session()
+        self._pending = set()
+        self.stats = {'fresh':0, 'not_modified':0, 'unchanged':0, 'changed':0}
+
+    def _path(self, url, params=None):
+        if params:
+            url = url + '?' + urlparse.urlencode(sorted(params.items()))
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def load(self, url, params=None):
+        ''' returns (meta, body) of the stored response, (None, None) if there is none '''
+        path = self._path(url, params)
+        if path in self._pending:
+            path += '.pending'
+        try:
+            with open(path+'.json') as f:
+                meta = json.load(f)
+            with open(path+'.body','rb') as f:
+                return meta, f.read()
+        except (OSError, ValueError):
+            return None, None
+
+    def store(self, url, params, body, headers={}):
+        path = self._path(url, params)
+        meta = {'url': url,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'fetched': time.time(),
+                'sha1': hashlib.sha1(body).hexdigest()}
+        target = path if self.autocommit else path+'.pending'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(target+'.body','wb') as f:
+            f.write(body)
+        with open(target+'.json','w') as f:
+            json.dump(meta, f)
+        if not self.autocommit:
+            self._pending.add(path)
+
+    def touch(self, url, params, meta):
+        ''' a 304 only refreshes the fetch time '''
+        meta = dict(meta, fetched=time.time())
+        path = self._path(url, params)
+        if path not in self._pending:
+            with open(path+'.json','w') as f:
+                json.dump(meta, f)
+
+    def commit(self):
+        for path in self._pending:
+            os.replace(path+'.pending.body', path+'.body')
+            os.replace(path+'.pending.json', path+'.json')
+        self._pending = set()
+
+    def discard(self):
+        for path in self._pending:
+            for ext in ('.pending.body','.pending.json'):
+                try:
+                    os.remove(path+ext)
+                except OSError:
+                    pass
+        self._pending = set()
+
+    def get(self, url, params=None, max_age=None):
+        '''
+        returns (text, changed). text is None when replaying a url that was never fetched.
+        a stored response younger than max_age seconds is returned without a request.
+        responses other than 200 are returned as is and not cached.
+        '''
+        meta, body = self.load(url, params)
+        if self.replay:
+            return (body.decode('utf-8') if body is not None else None), True
+        if meta and max_age is not None and time.time() - meta['fetched'] < max_age:
+            self.stats['fresh'] += 1
+            return body.decode('utf-8'), False
+        headers = {}
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        r = ratelimit.get(url, session=self.session, params=params, headers=headers)
+        if r.status_code == 304 and meta:
+            self.stats['not_modified'] += 1
+            self.touch(url, params, meta)
+            return body.decode('utf-8'), False
+        r.encoding = 'utf-8'
+        if r.status_code != 200:
+            return r.text, True
+        unchanged = meta is not None and meta['sha1'] == hashlib.sha1(r.content).hexdigest()
+        self.stats['unchanged' if unchanged else 'changed'] += 1
+        self.store(url, params, r.content, r.headers)
+        return r.text, not unchanged
+
+HTTP_CACHE = HTTPCache()
+
+class CargoFetcher:
+    '''
+    Pages through cargoquery results over one shared keep-alive session.
+
+    Pages are requested by offset so several can be in flight at once. At most `concurrency` requests run
+    at the same time (across every query using this fetcher) and request starts go through the wiki's
+    ratelimit bucket, so running more tables in parallel does not make us less polite to the wiki.
+    Each query keeps `fanout` pages in flight, which is also how many requests past the last page it can waste.
+    '''
+    def __init__(self, session, concurrency=WIKI_CONCURRENCY, fanout=2, limit=CARGO_QUERY_LIMIT):
+        self.session = session
+        self.limit = limit
+        self.concurrency = concurrency
+        self.fanout = fanout
+        self._slots = asyncio.Semaphore(concurrency)
+        self.requests = 0
+        self.failed = False
+
+    async def api(self, params):
+        '''
+        GET api.php with params, returns the decoded json or None if it failed 3 times.
+        responses are recorded in HTTP_CACHE so an ingest can be replayed offline.
+        '''
+        url = f'{WIKI_BASE}api.php'
+        params = dict(params, format='json')
+        if HTTP_CACHE.replay:
+            meta, body = HTTP_CACHE.load(url, params)
+            return json.loads(body) if body is not None else None
+        async with self._slots:
+            self.requests += 1
+            try:
+                status, headers, body = await ratelimit.aget(self.session, url, params=params)
+                if status != 200:
+                    raise ValueError('http status {}'.format(status))
+                rj = json.loads(body.decode('utf-8'))
+                HTTP_CACHE.store(url, params, body, headers)
+                return rj
+            except Exception as e:
+                error = e
+        print('error querying wiki {}: {!r}'.format(params, error))
+        self.failed = True
+        return None
+
+    async def fetch_page(self, params, offset):
+        ''' returns the rows of one page, None if it failed '''
+        rj = await self.api(dict(params, action='cargoquery', limit=self.limit, offset=offset))
+        if rj is None or 'cargoquery' not in rj:
+            self.failed = True
+            return None
+        return [a['title'] for a in rj['cargoquery']]
+
+    async def cargoquery(self, params, page_field=None, pages=None):
+        '''
+        all rows of a cargoquery, in order. params must have a total order_by or pages can overlap.
+        stops at the first page that fails, like the sequential scrapers did (self.failed is set).
+
+        if pages is given only rows where page_field is one of those page names are fetched.
+        '''
+        if pages is None:
+            return await self._all_pages(params)
+        pages = sorted(pages)
+        chunks = [pages[i:i+CARGO_PAGES_PER_QUERY] for i in range(0, len(pages), CARGO_PAGES_PER_QUERY)]
+        def escape(page):
+            return '"{}"'.format(page.replace('\\','\\\\').replace('"','\\"'))
+        # a chunk of pages rarely has more than one page of rows, so don't fetch ahead
+        results = await asyncio.gather(*[self._all_pages(dict(params, where='({}) AND {} IN ({})'.format(params['where'], page_field, ','.join(map(escape, chunk)))), fanout=1)
+                                         for chunk in chunks])
+        return [row for rows in results for row in rows]
+
+    async def _all_pages(self, params, fanout=None):
+        pages = {}
+        end = float('inf') # number of pages to keep
+        next_page = 0
+        async def worker():
+            nonlocal end, next_page
+            while next_page < end:
+                n = next_page
+                next_page += 1
+                rows = await self.fetch_page(params, n*self.limit)
+                if rows is None:
+                    end = min(end, n)
+                    continue
+                pages[n] = rows
+                if len(rows) < self.limit:
+                    end = min(end, n+1)
+        await asyncio.gather(*[worker() for i in range(fanout or self.fanout)])
+        return [row for n in range(end) for row in pages[n]]
+
+def wiki_session():
+    return aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60), connector=aiohttp.TCPConnector(limit_per_host=WIKI_CONCURRENCY))
+
+async def _with_fetcher(coro_func, **kwargs):
+    async with wiki_session() as session:
+        return await coro_func(CargoFetcher(session, **kwargs))
+
+async def scrape_wiki_async(pages=None, **kwargs):
+    '''
+    scrapes unique items, skill gems and passive skills in parallel, only rows on the given page names if pages is set.
+
+    returns (uniques, gems, passives, complete), complete is False if any request failed and the results are partial.
+    '''
+    async with wiki_session() as session:
+        fetcher = CargoFetcher(session, **kwargs)
+        start = time.monotonic()
+        res = await asyncio.gather(scrape_unique_items_async(fetcher, pages), scrape_skill_gems_async(fetcher, pages), scrape_passive_skills_async(fetcher, pages))
+        print('wiki scrape: {} requests in {:.1f}s'.format(fetcher.requests, time.monotonic()-start))
+        return (*res, not fetcher.failed)
+
+def scrape_wiki(pages=None, **kwargs):
+    return asyncio.run(scrape_wiki_async(pages, **kwargs))
+
+async def cargo_namespaces_async(fetcher):
+    '''
+    ids of the namespaces that pages of the scraped cargo tables are in, or None if they could not be fetched.
+    uniques and gems are in the main namespace, passive skills are on their own data pages outside of it.
+    '''
+    results = await asyncio.gather(*[fetcher.cargoquery({'tables':table, 'fields':f'{table}._pageNamespace=ns',
+                                                         'group_by':f'{table}._pageNamespace', 'order_by':f'{table}._pageNamespace'})
+                                     for table in WIKI_CARGO_TABLES])
+    if fetcher.failed:
+        return None
+    return {int(row['ns']) for rows in results for row in rows}
+
+async def changed_pages_async(fetcher, since):
+    '''
+    titles of pages edited, created, deleted or moved (both titles) on the wiki since `since` (a WIKI_TIMESTAMP_FORMAT
+    string) in any namespace the scraped cargo tables use, or None if the change list could not be fetched.
+    '''
+    namespaces = await cargo_namespaces_async(fetcher)
+    if namespaces is None:
+        return None
+    params = {'action':'query', 'list':'recentchanges', 'rcend':since, 'rcnamespace':'|'.join(map(str, sorted(namespaces | {0}))),
+              'rctype':'edit|new|log', 'rcprop':'title|loginfo', 'rclimit':500}
+    pages = set()
+    while True:
+        rj = await fetcher.api(params)
+        if rj is None or 'query' not in rj:
+            return None
+        for change in rj['query']['recentchanges']:
+            pages.add(change['title'])
+            if change.get('logtype') == 'move':
+                pages.add(change.get('logparams',{}).get('target_title'))
+        if 'continue' not in rj:
+            break
+        params.update(rj['continue'])
+    pages.discard(None)
+    return pages
+
+def changed_pages(since, **kwargs):
+    return asyncio.run(_with_fetcher(lambda fetcher: changed_pages_async(fetcher, since), **kwargs))
+
 # cargo wiki field: local sqlitedb field
 GEM_LEVELS_VARIABLE_FIELDS={
                 #gem_levels fields
@@ -200,56 +517,42 @@ SKILL_QUALITY_PROPERTY_MAPPING={
                 'skill_quality.stat_text':'q_stat_text',
                 'skill_quality.weight':'q_weight',
         }
-def scrape_skill_gems():
-        query_limit = 500
-        last_batch_size = query_limit
-        last_rowid = -1
+SKILL_GEMS_QUERY={
+        # table joins
+        'tables': 'skill_gems,skill,skill_levels,skill_quality,gem_levels',
+        'join_on': 'skill._pageName=skill_levels._pageName,skill._pageName=skill_quality._pageName,skill.skill_id=skill_gems.skill_id,'
+                   'skill_gems._pageName=gem_levels._pageName,skill_levels.level=gem_levels.level',
+        # requested fields
+        'fields': ','.join(['='.join((k,v)) for k,v in SKILL_GEM_PROPERTY_MAPPING.items()])+',skill_gems._rowID=rowid',
+        # sort and filter (_pageNamespace == 0 filters out Template: pages) (order by skill level so lv20 stats overwrite)
+        'where': '(skill_levels.level=skill.max_level OR skill_levels.level<2) AND skill_gems._pageNamespace=0',
+        # 'where': '(skill_levels.level=skill.max_level OR skill_levels.level<2) AND skill_gems._pageNamespace=0 AND skill.skill_id="SupportArrogance"', # replaces line above for debug
+        'order_by': 'skill_gems._rowID,skill_levels.level,skill_quality._rowID',
+        }
+
+async def scrape_skill_gems_async(fetcher, pages=None):
         # use dict to prevent duplicate entries from overlap
         keyed_results = {}
-        while last_batch_size == query_limit:
-            # table joins
-            # requested fields
-            # sort and filter (_pageNamespace == 0 filters out Template: pages) (order by skill level so lv20 stats overwrite)
-            query = f'''{WIKI_BASE}api.php?action=cargoquery&format=json&tables=skill_gems,skill,skill_levels,skill_quality,gem_levels&join_on=skill._pageName=skill_levels._pageName,skill._pageName=skill_quality._pageName,skill.skill_id=skill_gems.skill_id,skill_gems._pageName=gem_levels._pageName,skill_levels.level=gem_levels.level&fields='''+\
-                f'''{','.join(['='.join((k,v)) for k,v in SKILL_GEM_PROPERTY_MAPPING.items()])},skill_gems._rowID=rowid'''+\
-                f'''&where=(skill_levels.level=skill.max_level OR skill_levels.level<2) AND skill_gems._rowID >= {last_rowid - 1} '''+\
-                f'''AND skill_gems._pageNamespace=0&order_by=skill_gems._rowID,skill_levels.level&limit={query_limit}'''
-                # f'''AND skill_gems._pageNamespace=0 AND skill.skill_id="SupportArrogance"&order_by=skill_gems._rowID,skill_levels.level&limit={query_limit}''' # replaces line above for debug
-            api_results = []
-            for i in range(3):
-                try:
-                    r = requests.get(query)
-                    r.encoding = 'utf-8'
-                    rj = r.json()
-                    last_batch_size = len(rj['cargoquery'])
-                    api_results = [a['title'] for a in rj['cargoquery']]
-                    break
-                except Exception as e:
-                    time.sleep(4)
-                    #error, trying again.
-            if not api_results:
-                print('error scraping skills with query:',query)
-                print(r.headers)
-                break
-            for res in api_results:
-                thislevel = int(res.pop('level',None))
-                last_rowid = int(res.pop('rowid'))
-                if res['name'] not in keyed_results:
-                    # level 0
-                    keyed_results[res['name']] = res
-                elif thislevel == 1:
-                    # update with all non-null values
-                    keyed_results[res['name']].update({k:v for k,v in res.items() if v})
-                if thislevel == int(res['max_level']):
-                    # add _max version of all _VARIABLE_FIELDS
-                    keyed_results[res['name']].update({'{}_max'.format(k):v for k,v in res.items() if k in SKILL_GEM_VARIABLE_FIELDS.values()})
-                    keyed_results[res['name']].update({'{}_max'.format(k):v for k,v in res.items() if k in GEM_LEVELS_VARIABLE_FIELDS.values()})
-                # trim skill_id to get skill_id_group for grouping trans gems
-                keyed_results[res['name']]['skill_id_group'] = re.sub(r'Alt[a-zA-Z]$|Plus$|^Vaal', '', res.get('skill_id',''))
-            time.sleep(3)
-            # break # for debug
+        for res in await fetcher.cargoquery(SKILL_GEMS_QUERY, 'skill_gems._pageName', pages):
+            thislevel = int(res.pop('level',None))
+            res.pop('rowid')
+            if res['name'] not in keyed_results:
+                # level 0
+                keyed_results[res['name']] = res
+            elif thislevel == 1:
+                # update with all non-null values
+                keyed_results[res['name']].update({k:v for k,v in res.items() if v})
+            if thislevel == int(res['max_level']):
+                # add _max version of all _VARIABLE_FIELDS
+                keyed_results[res['name']].update({'{}_max'.format(k):v for k,v in res.items() if k in SKILL_GEM_VARIABLE_FIELDS.values()})
+                keyed_results[res['name']].update({'{}_max'.format(k):v for k,v in res.items() if k in GEM_LEVELS_VARIABLE_FIELDS.values()})
+            # trim skill_id to get skill_id_group for grouping trans gems
+            keyed_results[res['name']]['skill_id_group'] = re.sub(r'Alt[a-zA-Z]$|Plus$|^Vaal', '', res.get('skill_id',''))
         return keyed_results.values()
 
+def scrape_skill_gems():
+        return asyncio.run(_with_fetcher(scrape_skill_gems_async))
+
 def scrape_skill_quality():
     ''' this is no longer used as its (practically) baked into scrape_skill_gems '''
     query_limit = 500
@@ -262,17 +565,14 @@ def scrape_skill_quality():
             f'''&fields={','.join(['='.join((k,v)) for k,v in SKILL_QUALITY_PROPERTY_MAPPING.items()])}'''+\
             f''',skill_quality._rowID=rowid&where=skill_quality._rowID>{last_rowid - 1} &order_by=skill_quality._rowID&limit={query_limit}'''
         api_results = []
-        for i in range(3):
-            try:
-                r = requests.get(query)
-                r.encoding = 'utf-8'
-                rj = r.json()
-                last_batch_size = len(rj['cargoquery'])
-                api_results = [a['title'] for a in rj['cargoquery']]
-                break
-            except:
-                time.sleep(4)
-                #error, trying again.
+        r = ratelimit.get(query)
+        r.encoding = 'utf-8'
+        try:
+            rj = r.json()
+            last_batch_size = len(rj['cargoquery'])
+            api_results = [a['title'] for a in rj['cargoquery']]
+        except (JSONDecodeError, KeyError):
+            pass
         if not api_results:
             print('error scraping skill quality with query:',query)
             print(r.headers)
@@ -282,7 +582,6 @@ def scrape_skill_quality():
             keyed_results[res['name']] = res
             # res['impl'] = remove_wiki_formats(html.unescape(res['impl']))
             # res['expl'] = remove_wiki_formats(html.unescape(res['expl']))#.replace('<br>','\n')
-        time.sleep(3)
     return keyed_results.values()
     
 UNIQUE_ITEM_PROPERTY_MAPPING={
@@ -330,12 +629,12 @@ UNIQUE_ITEM_PROPERTY_MAPPING={
 }
 
 #image_url is only available if we were lucky enough to scrape it from the db.
-def get_image_url(pageName, image_url, is_div_card=False):
+def get_image_url(pageName, image_url, is_div_card=False, max_age=IMAGE_URL_MAX_AGE):
         #returns a (best guess) direct url to the main (thumbnail) image for this page.
+        #answers are cached for max_age seconds, see HTTPCache
         query = f'{WIKI_BASE}api.php?action=query&titles={pageName}&prop=pageimages|images&format=json&pithumbsize=10000&imlimit=500'
-        r = requests.get(query)
-        r.encoding = 'utf-8'
-        rj = r.json()
+        text, changed = HTTP_CACHE.get(query, max_age=max_age)
+        rj = json.loads(text)
         pagenum,data = rj['query']['pages'].popitem()
         if int(pagenum)==-1:
                 return None
@@ -356,9 +655,8 @@ def get_image_url(pageName, image_url, is_div_card=False):
 
                 image_url = all_images[-1]
         
-        r = requests.get(f'{WIKI_BASE}api.php?action=query&titles={image_url}&prop=imageinfo&iiprop=url&format=json')
-        r.encoding = 'utf-8'
-        rj = r.json()
+        text, changed = HTTP_CACHE.get(f'{WIKI_BASE}api.php?action=query&titles={image_url}&prop=imageinfo&iiprop=url&format=json', max_age=max_age)
+        rj = json.loads(text)
         pagenum,data = rj['query']['pages'].popitem()
         if int(pagenum)==-1:
                 return None
@@ -366,44 +664,29 @@ def get_image_url(pageName, image_url, is_div_card=False):
                 return data['imageinfo'][0]['url']
         return None
 
-def scrape_unique_items():
-    query_limit = 500
-    last_batch_size = query_limit
-    last_rowid = -1
+UNIQUE_ITEMS_QUERY={
+    'tables': 'items,weapons,shields,armours,jewels,flasks',
+    'join_on': 'items._pageName=weapons._pageName,items._pageName=shields._pageName,items._pageName=armours._pageName,'
+               'items._pageName=jewels._pageName,items._pageName=flasks._pageName',
+    'fields': ','.join(['='.join((k,v)) for k,v in UNIQUE_ITEM_PROPERTY_MAPPING.items()])+',items._rowID=rowid',
+    'where': "rarity='Unique'",
+    # 'where': "rarity='Unique' AND items._pageName = \"Doryani's Delusion (Evasion)\"",
+    # Doryani's Delusion (Evasion), Watcher's Eye, swap above row in to debug.
+    'group_by': 'items._pageName',
+    'order_by': 'items._rowID',
+    }
+
+async def scrape_unique_items_async(fetcher, pages=None):
     # use dict to prevent duplicate entries from overlap
     keyed_results = {}
-    while last_batch_size == query_limit:
-        query = f'''{WIKI_BASE}api.php?action=cargoquery&format=json&tables=items,weapons,shields,armours,jewels,flasks&join_on=items._pageName=weapons._pageName,'''+\
-            '''items._pageName=shields._pageName,items._pageName=armours._pageName,items._pageName=jewels._pageName,items._pageName=flasks._pageName'''+\
-            f'''&fields={','.join(['='.join((k,v)) for k,v in UNIQUE_ITEM_PROPERTY_MAPPING.items()])},'''+\
-            f'''items._rowID=rowid&where=rarity=\'Unique\' AND items._rowID>={last_rowid - 1}&group_by=items._pageName&order_by=items._rowID&limit={query_limit}'''
-            # f'''items._rowID=rowid&where=rarity=\'Unique\' AND items._pageName = "Doryani's Delusion (Evasion)"&group_by=items._pageName&order_by=items._rowID&limit={query_limit}'''
-            # Doryani's Delusion (Evasion), Watcher's Eye, swap above row in to debug.
-        api_results = []
-        for i in range(3):
-            try:
-                r = requests.get(query)
-                r.encoding = 'utf-8'
-                rj = r.json()
-                last_batch_size = len(rj['cargoquery'])
-                api_results = [a['title'] for a in rj['cargoquery']]
-                break
-            except:
-                time.sleep(4)
-                #error, trying again.
-        if not api_results:
-            print('error scraping unique items with query:',query)
-            print(r.headers)
-            break
-        for res in api_results:
-            last_rowid = int(res.pop('rowid'))
-            keyed_results[res['name']] = {k:remove_wiki_formats(html.unescape(v or '')) for k,v in res.items()}
-            # force add impl and expl
-            res['impl'] = res.get('impl','')
-            res['expl'] = res.get('expl','')
-        time.sleep(3)
+    for res in await fetcher.cargoquery(UNIQUE_ITEMS_QUERY, 'items._pageName', pages):
+        res.pop('rowid')
+        keyed_results[res['name']] = {k:remove_wiki_formats(html.unescape(v or '')) for k,v in res.items()}
     return keyed_results.values()
 
+def scrape_unique_items():
+    return asyncio.run(_with_fetcher(scrape_unique_items_async))
+
 PASSIVE_SKILLS_PROPERTY_MAPPING={
         'passive_skills._pageName':'pagename',
         'passive_skills.stat_text':'desc',
@@ -413,41 +696,24 @@ PASSIVE_SKILLS_PROPERTY_MAPPING={
         'passive_skills.icon':'image_url',
 }
 
-def scrape_passive_skills():
-    query_limit = 500
-    last_batch_size = query_limit
-    last_rowid = -1
+PASSIVE_SKILLS_QUERY={
+    'tables': 'passive_skills',
+    'fields': ','.join(['='.join((k,v)) for k,v in PASSIVE_SKILLS_PROPERTY_MAPPING.items()])+',passive_skills._rowID=rowid',
+    'where': 'passive_skills.is_keystone OR passive_skills.is_notable',
+    'order_by': 'passive_skills._rowID',
+    }
+
+async def scrape_passive_skills_async(fetcher, pages=None):
     # use dict to prevent duplicate entries from overlap
     keyed_results = {}
-    while last_batch_size == query_limit:
-        query = f'''{WIKI_BASE}api.php?action=cargoquery&format=json&tables=passive_skills'''+\
-            f'''&fields={','.join(['='.join((k,v)) for k,v in PASSIVE_SKILLS_PROPERTY_MAPPING.items()])},'''+\
-            f'''passive_skills._rowID=rowid&where=passive_skills._rowID>={last_rowid - 1} '''+\
-            f'''AND (passive_skills.is_keystone OR passive_skills.is_notable)&order_by=passive_skills._rowID&limit={query_limit}'''
-        api_results = []
-        for i in range(3):
-            try:
-                r = requests.get(query)
-                r.encoding = 'utf-8'
-                rj = r.json()
-                last_batch_size = len(rj['cargoquery'])
-                api_results = [a['title'] for a in rj['cargoquery']]
-                break
-            except:
-                time.sleep(4)
-                #error, trying again.
-        if not api_results:
-            print('error scraping passive skills with query:',query)
-            print(r.headers)
-            break
-        for res in api_results:
-            last_rowid = int(res.pop('rowid'))
-            res['desc'] = remove_wiki_formats(html.unescape(res.get('desc','') or ''))
-            keyed_results[res['name']] = res
-            # res['impl'] = remove_wiki_formats(html.unescape(res['impl']))
-            # res['expl'] = remove_wiki_formats(html.unescape(res['expl']))#.replace('<br>','\n')
-        time.sleep(3)
+    for res in await fetcher.cargoquery(PASSIVE_SKILLS_QUERY, 'passive_skills._pageName', pages):
+        res.pop('rowid')
+        res['desc'] = remove_wiki_formats(html.unescape(res.get('desc','') or ''))
+        keyed_results[res['name']] = res
     return keyed_results.values()
+
+def scrape_passive_skills():
+    return asyncio.run(_with_fetcher(scrape_passive_skills_async))
         
 #only the fields we care about.
 #itemclass 4 is gems. probably the only one we need
@@ -460,161 +726,223 @@ def scrape_passive_skills():
                     # 'divineValue'
                     # ]
                     
-def get_ninja_prices(league='tmpStandard'):
-        '''use poe.ninja api to get item prices'''
-        itemtypes = [
-             'SkillGem',
-             'UniqueJewel',
-             'UniqueFlask',
-             'UniqueWeapon',
-             'UniqueArmour',
-             'UniqueAccessory',
-             'UniqueTincture',
-             'UniqueRelic',
-             'UniqueMap',
-             ]
-        data=[]
+NINJA_ITEM_TYPES = [
+     'SkillGem',
+     'UniqueJewel',
+     'UniqueFlask',
+     'UniqueWeapon',
+     'UniqueArmour',
+     'UniqueAccessory',
+     'UniqueTincture',
+     'UniqueRelic',
+     'UniqueMap',
+     ]
+NINJA_CURRENCY_TYPES = ['Currency',
+                 'Fragment',
+                 'Runegraft',
+                 'AllflameEmber',
+                 'Tattoo',
+                 'Omen',
+                 'DjinnCoin',
+                 'DivinationCard',
+                 'Artifact',
+                 'Oil',
+                 'DeliriumOrb',
+                 'Scarab',
+                 'Astrolabe',
+                 'Fossil',
+                 'Resonator',
+                 'Essence']
+# itemtypes = [('item','DivinationCard'),
+             # ('item','Oil'),
+             # ('item','Scarab'),
+             # ('item','Fossil'),
+             # ('item','Resonator'),
+             # ('item','Essence'),
+             # ('item','Resonator'),
+             # ]
+''' 
+omitted:
+Prophecy
+'''
+'''
+omitted categories:
+Watchstones
+Incubators
+Base Types
+Helmet Enchants
+(Unique) Maps
+Beasts
+Vials
+'''
+# parallel fetches across leagues and types, the poe.ninja ratelimit bucket still caps the request rate
+NINJA_WORKERS = 8
+
+def get_ninja_item_type(league, itemtype):
+        '''
+        poe.ninja item prices of one type as (rows, changed), rows is None if unavailable.
+        an unchanged response (see HTTPCache) is not parsed and has no rows, a changed one can have none either.
+        '''
         api = 'https://poe.ninja/poe1/api/economy/stash/current/item/overview?league={}&type={}'
-        for itemtype in itemtypes:
-            r = requests.get(api.format(league,itemtype))
-            r.encoding = 'utf-8'
-            try:
-                rj = r.json()
-            except JSONDecodeError:
-                return None
-            if 'lines' not in rj: #rj['status'] != 200:
-                print('failed to fetch poe.ninja data for league:',league,'(normal for event leagues)')
-                return
-            for x in rj['lines']:
-                if 'links' in x:
-                    if x['name'].strip().strip('Foulborn ') not in ['Tabula Rasa','Skin of the Lords','Skin of the Loyal','The Goddess Unleashed','Oni-Goroshi','Shadowstitch']:
-                        continue
-                if itemtype == 'SkillGem':
-                    # use 20/20 for vaal gems
-                    # use 1/20 for normal gems
-                    if x['gemLevel']!=1:
-                        if re.search('(?: |^)Vaal ',x['name']) and int(x['gemLevel'])==20 and int(x.get('gemQuality',0))==20:
-                            pass
-                        else:
-                            continue
-                    elif int(x.get('gemQuality',0))!=20:
+        text, changed = HTTP_CACHE.get(api.format(league,itemtype))
+        if not changed:
+            return [], False
+        try:
+            rj = json.loads(text)
+        except (JSONDecodeError, TypeError):
+            return None, True
+        if 'lines' not in rj: #rj['status'] != 200:
+            return None, True
+        data=[]
+        for x in rj['lines']:
+            if 'links' in x:
+                if x['name'].strip().strip('Foulborn ') not in ['Tabula Rasa','Skin of the Lords','Skin of the Loyal','The Goddess Unleashed','Oni-Goroshi','Shadowstitch']:
+                    continue
+            if itemtype == 'SkillGem':
+                # use 20/20 for vaal gems
+                # use 1/20 for normal gems
+                if x['gemLevel']!=1:
+                    if re.search('(?: |^)Vaal ',x['name']) and int(x['gemLevel'])==20 and int(x.get('gemQuality',0))==20:
+                        pass
+                    else:
                         continue
+                elif int(x.get('gemQuality',0))!=20:
+                    continue
+            data.append({'name': x['name'],
+                         'id': x['id'],
+                         'icon': x['icon'],
+                         'chaosValue': x['chaosValue'],
+                         'itemClass': x.get('itemType',itemtype),
+                         'league': league,
+                         'divineValue': x.get('divineValue',None), # legacy items may not have divineValue (exalted era)
+                        })
+        return data, True
+
+def get_ninja_currency_type(league, itemtype):
+        '''poe.ninja currency prices of one type as (rows, changed), see get_ninja_item_type'''
+        ''' this ONLY uses the in game exchange rates now '''
+        api = 'https://poe.ninja/poe1/api/economy/exchange/current/overview?league={}&type={}'
+        text, changed = HTTP_CACHE.get(api.format(league,itemtype))
+        if not changed:
+                return [], False
+        try:
+                rj = json.loads(text)
+        except (JSONDecodeError, TypeError):
+                return None, True
+        if 'lines' not in rj: #rj['status'] != 200:
+            return None, True
+        data=[]
+        id_map = {}
+        generic_images = {'DivinationCard': '/gen/image/WzI1LDE0LHsiZiI6IjJESXRlbXMvRGl2aW5hdGlvbi9JbnZlbnRvcnlJY29uIiwidyI6MSwiaCI6MSwic2NhbGUiOjF9XQ/f34bf8cbb5/InventoryIcon.png',
+                        }
+        '''
+        stats:
+        id
+        name
+        icon
+        chaosValue
+        exaltedValue (not used? but can be)
+        itemClass (only used for gems)
+        league
+        timestamp
+        divineValue
+        '''
+        # conversion = rj['core']['rates']['divine']
+        for x in rj['lines']:
+                id_map[x['id']] = x['primaryValue']
+        for x in rj['items']:
                 data.append({'name': x['name'],
                              'id': x['id'],
-                             'icon': x['icon'],
-                             'chaosValue': x['chaosValue'],
-                             'itemClass': x.get('itemType',itemtype),
+                             'icon': f"https://web.poecdn.com{x['image'] if 'image' in x else generic_images.get(itemtype,None)}",
+                             'chaosValue': id_map[x['id']],
+                             # 'itemClass': x['category'], not in currency table
                              'league': league,
-                             'divineValue': x.get('divineValue',None), # legacy items may not have divineValue (exalted era)
+                             # 'divineValue': id_map[x['id']] * conversion
                             })
-            time.sleep(3)
-        for d in data:
-            d.update({'league':league})
+        return data, True
+
+def get_ninja_prices(league='tmpStandard'):
+        '''use poe.ninja api to get item prices
+        only item types whose response changed since the last fetch are returned (see HTTPCache)'''
+        data=[]
+        for itemtype in NINJA_ITEM_TYPES:
+            rows, changed = get_ninja_item_type(league, itemtype)
+            if rows is None:
+                print('failed to fetch poe.ninja data for league:',league,'(normal for event leagues)')
+                return None
+            data.extend(rows)
         return data
+
 def get_ninja_rates(league='tmpStandard'):
-        '''use poe.ninja api to get currency prices'''
-        ''' this ONLY uses the in game exchange rates now '''
-        # itemtypes = [('item','DivinationCard'),
-                     # ('item','Oil'),
-                     # ('item','Scarab'),
-                     # ('item','Fossil'),
-                     # ('item','Resonator'),
-                     # ('item','Essence'),
-                     # ('item','Resonator'),
-                     # ]
-        ''' 
-        omitted:
-        Prophecy
-        '''
-        currencytypes = ['Currency',
-                         'Fragment',
-                         'Runegraft',
-                         'AllflameEmber',
-                         'Tattoo',
-                         'Omen',
-                         'DjinnCoin',
-                         'DivinationCard',
-                         'Artifact',
-                         'Oil',
-                         'DeliriumOrb',
-                         'Scarab',
-                         'Astrolabe',
-                         'Fossil',
-                         'Resonator',
-                         'Essence']
+        '''use poe.ninja api to get currency prices
+        only currency types whose response changed since the last fetch are returned (see HTTPCache)'''
+        data=[]
+        for itemtype in NINJA_CURRENCY_TYPES:
+            rows, changed = get_ninja_currency_type(league, itemtype)
+            if rows is None:
+                print('failed to fetch poe.ninja currency data for',itemtype,'in',league,'(normal for event leagues)')
+                continue
+            data.extend(rows)
+        return data
 
+def fetch_ninja(leagues, workers=NINJA_WORKERS):
         '''
-        omitted categories:
-        Watchstones
-        Incubators
-        Base Types
-        Helmet Enchants
-        (Unique) Maps
-        Beasts
-        Vials
+        fetches and parses every poe.ninja item and currency type for every league on a thread pool.
+        yields (table, league, type, rows, changed) as each available type finishes so the caller can write while the rest are
+        still in flight (rows can be empty, an unchanged type has none), then prints how long each league took.
         '''
-        data=[]
-        api = 'https://poe.ninja/poe1/api/economy/exchange/current/overview?league={}&type={}'
-        for itemtype in currencytypes:
-            r = requests.get(api.format(league,itemtype))
-            r.encoding = 'utf-8'
+        def fetch(func, league, itemtype):
+            start = time.monotonic()
             try:
-                    rj = r.json()
-            except JSONDecodeError:
-                    print("Error fetching currency data for:",itemtype[1],'in',league,'(normal for event leagues)')
+                rows, changed = func(league, itemtype)
+            except Exception as e:
+                print('error fetching poe.ninja {} for {}: {!r}'.format(itemtype, league, e))
+                rows, changed = None, True
+            return start, time.monotonic(), rows, changed
+        jobs = [(table, func, league, itemtype)
+                for league in leagues
+                for table, func, types in (('ninja_data', get_ninja_item_type, NINJA_ITEM_TYPES), ('ninja_currency_data', get_ninja_currency_type, NINJA_CURRENCY_TYPES))
+                for itemtype in types]
+        stats = {league: {'start': float('inf'), 'end': 0, 'rows': 0, 'unchanged': 0, 'failed': 0} for league in leagues}
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ninja') as pool:
+            futures = {pool.submit(fetch, func, league, itemtype): (table, league, itemtype) for table, func, league, itemtype in jobs}
+            for future in as_completed(futures):
+                table, league, itemtype = futures[future]
+                start, end, rows, changed = future.result()
+                s = stats[league]
+                s['start'], s['end'] = min(s['start'], start), max(s['end'], end)
+                if rows is None:
+                    s['failed'] += 1
                     continue
-            if 'lines' not in rj: #rj['status'] != 200:
-                print('failed to fetch poe.ninja currency data for league:',league,'(normal for event leagues)')
-                continue
-            id_map = {}
-            generic_images = {'DivinationCard': '/gen/image/WzI1LDE0LHsiZiI6IjJESXRlbXMvRGl2aW5hdGlvbi9JbnZlbnRvcnlJY29uIiwidyI6MSwiaCI6MSwic2NhbGUiOjF9XQ/f34bf8cbb5/InventoryIcon.png',
-                            }
-            '''
-            stats:
-            id
-            name
-            icon
-            chaosValue
-            exaltedValue (not used? but can be)
-            itemClass (only used for gems)
-            league
-            timestamp
-            divineValue
-            '''
-            # conversion = rj['core']['rates']['divine']
-            for x in rj['lines']:
-                    id_map[x['id']] = x['primaryValue']
-            for x in rj['items']:
-                    data.append({'name': x['name'],
-                                 'id': x['id'],
-                                 'icon': f"https://web.poecdn.com{x['image'] if 'image' in x else generic_images.get(itemtype,None)}",
-                                 'chaosValue': id_map[x['id']],
-                                 # 'itemClass': x['category'], not in currency table
-                                 'league': league,
-                                 # 'divineValue': id_map[x['id']] * conversion
-                                })
-        return data
+                if not changed:
+                    s['unchanged'] += 1
+                else:
+                    s['rows'] += len(rows)
+                yield table, league, itemtype, rows, changed
+        for league, s in stats.items():
+            print('poe.ninja {}: {} rows, {} unchanged, {} unavailable types in {:.1f}s{}'.format(
+                league, s['rows'], s['unchanged'], s['failed'], s['end'] - s['start'],
+                ' (normal for event leagues)' if s['failed'] == len(NINJA_ITEM_TYPES) + len(NINJA_CURRENCY_TYPES) else ''))
+
 def get_lab_urls(date):
     ''' returns all 4 lab urls from poelab.com 
         will return None for each if date on poelab doesnt match provided date (has not been updated yet)
-        date is format: %Y-%m-%d'''
+        date is format: %Y-%m-%d
+        the difficulty pages are fetched in parallel (still paced by poelab's ratelimit bucket)'''
     labpages = []
-    ret = []
-    scraper = cloudscraper.create_scraper()
-    with scraper.get('https://www.poelab.com/') as r:
-        etree = lxmlhtml.fromstring(r.text)
-        labpages= etree.xpath('//h2/a[@class="redLink"]/@href')
-    for url in reversed(labpages[:4]):
-        with scraper.get(url) as r:
+    with cloudscraper.create_scraper() as scraper:
+        with ratelimit.get('https://www.poelab.com/', session=scraper) as r:
             etree = lxmlhtml.fromstring(r.text)
-            t = etree.xpath('//img[@id="notesImg"]/@src')
-            if t:
-                t=t[0]
-            if date not in t:
-                ret.append(None)
-            else:
-                ret.append(t)
-    return ret
+            labpages= etree.xpath('//h2/a[@class="redLink"]/@href')
+        def lab_url(url):
+            with ratelimit.get(url, session=scraper) as r:
+                etree = lxmlhtml.fromstring(r.text)
+                t = etree.xpath('//img[@id="notesImg"]/@src')
+                if t and date in t[0]:
+                    return t[0]
+            return None
+        with ThreadPoolExecutor(max_workers=4, thread_name_prefix='poelab') as pool:
+            return list(pool.map(lab_url, reversed(labpages[:4])))
 if __name__ == '__main__':
     # poeninja scrapers:
     # print(get_ninja_rates())
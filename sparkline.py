@@ -0,0 +1,58 @@
+'''
+Small price charts as PNG bytes, written with zlib only so the bot needs no imaging library.
+'''
+import struct
+import zlib
+
+LINE_COLOR = (175, 96, 26, 255)
+FILL_COLOR = (175, 96, 26, 60)
+AXIS_COLOR = (128, 128, 128, 90)
+
+def png(width, height, rows):
+    ''' rows is a list of height bytearrays holding width RGBA pixels each '''
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    raw = b''.join(b'\x00' + bytes(row) for row in rows)
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, 9))
+            + chunk(b'IEND', b''))
+
+def sample(points, width, start=None, end=None):
+    '''
+    points is [(time, value), ...] sorted by time, each value holds until the next point (prices only
+    get a point when they change). returns width values evenly spaced from start to end.
+    '''
+    start = max(start or points[0][0], points[0][0])
+    end = max(end or points[-1][0], start + 1)
+    values = []
+    i = 0
+    for x in range(width):
+        t = start + (end - start) * x / (width - 1)
+        while i + 1 < len(points) and points[i + 1][0] <= t:
+            i += 1
+        values.append(points[i][1])
+    return values
+
+def render(points, width=320, height=80, start=None, end=None):
+    ''' line chart of points (see sample) scaled to fill the image, returns PNG bytes. points without a value are skipped '''
+    points = [(t, v) for t, v in points if v is not None]
+    if not points:
+        raise ValueError('no values to draw')
+    values = sample(points, width, start, end)
+    low, high = min(values), max(values)
+    span = (high - low) or 1
+    pad = 3
+    ys = [round(pad + (height - 1 - 2*pad) * (1 - (v - low) / span)) for v in values]
+    rows = [bytearray(width * 4) for y in range(height)]
+    def put(x, y, color):
+        rows[y][x*4:x*4+4] = bytes(color)
+    for x in range(width):
+        put(x, height - 1, AXIS_COLOR)
+        for y in range(ys[x] + 1, height - 1):
+            put(x, y, FILL_COLOR)
+        # join to the previous column so steps are drawn as vertical lines
+        prev = ys[x - 1] if x else ys[x]
+        for y in range(min(prev, ys[x]), max(prev, ys[x]) + 1):
+            put(x, y, LINE_COLOR)
+    return png(width, height, rows)